@@ -0,0 +1,214 @@
+# coding=utf-8
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from inspect import iscoroutinefunction
+from threading import Thread
+from time import perf_counter
+
+from FHUtils import open_files_limit
+
+# Number of operations run at once when the engine starts; the limit then
+# adapts to the latency of the storage
+INITIAL_LIMIT = 16
+
+# The storage is considered overloaded when the recent latency of its
+# operations is this many times the long-term one
+LATENCY_TOLERANCE = 2.0
+
+# Weights of the newest latency in the recent and the long-term averages
+RECENT_WEIGHT = 0.1
+LONG_TERM_WEIGHT = 0.01
+
+# Share of the limit kept when the storage is overloaded
+BACKOFF = 0.9
+
+
+def _timed(fn, args):
+    # The latency is measured on the I/O thread, so a busy event loop does
+    # not count as a slow storage
+    start = perf_counter()
+    result = fn(*args)
+    return result, perf_counter() - start
+
+
+class AdaptiveLimiter:
+    '''
+    Limits the number of operations run at once and adapts the limit to
+    their latency, much like TCP congestion control: while the recent
+    latency stays close to the long-term one, the limit grows by one per
+    completed operation until the storage is first found overloaded, and
+    by one per `limit` operations after that. When the latency rises, the
+    storage is considered overloaded and the limit is cut, at most once per
+    round trip.
+
+    It is only used by the thread of the event loop.
+    '''
+    def __init__(self, max_limit, initial_limit=INITIAL_LIMIT):
+        self._max_limit = max(max_limit, 1)
+        self._limit = float(min(max(initial_limit, 1), self._max_limit))
+        self._running = 0
+        self._waiters = deque()
+        self._recent = None
+        self._long_term = None
+        self._last_backoff = 0.0
+        self._slow_start = True
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    async def acquire(self):
+        if self._running < self.limit and not self._waiters:
+            self._running += 1
+            return
+        # The slot is handed over by release()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def release(self, latency=None):
+        '''
+        Free the slot of a completed operation. Only operations of a
+        comparable size, e.g. reads of one chunk, pass their latency.
+        '''
+        busy = self._running >= self.limit
+        self._running -= 1
+        if latency is not None:
+            self._adapt(latency, busy)
+        while self._waiters and self._running < self.limit:
+            self._running += 1
+            self._waiters.popleft().set_result(None)
+
+    def _adapt(self, latency, busy):
+        if self._recent is None:
+            self._recent = self._long_term = latency
+            return
+        self._recent += RECENT_WEIGHT * (latency - self._recent)
+        self._long_term += LONG_TERM_WEIGHT * (latency - self._long_term)
+
+        if self._recent > self._long_term * LATENCY_TOLERANCE:
+            # Operations started before a cut still see the old limit
+            now = perf_counter()
+            if now - self._last_backoff > self._recent:
+                self._limit = max(self._limit * BACKOFF, 1.0)
+                self._last_backoff = now
+                self._slow_start = False
+        elif busy:
+            # The limit only grows while it is reached
+            step = 1.0 if self._slow_start else 1.0 / self._limit
+            self._limit = min(self._limit + step, self._max_limit)
+
+
+class AsyncEngine(Executor):
+    '''
+    Executor running coroutine functions as tasks of an asyncio event loop
+    in its own thread, e.g. File.set_file_data_async. The coroutines pass
+    their blocking calls, such as opening and reading a file, to call(),
+    which runs them on I/O threads as long as the adaptive limit of
+    operations in flight allows. Thousands of files can be in progress at
+    once: the I/O threads only wait in system calls, while the Python side,
+    hashing included, runs in the thread of the loop.
+
+    Other functions are run on the I/O threads as a whole, under the same
+    limit.
+
+    max_workers is the highest limit of operations in flight. I/O threads
+    are only started as the limit grows.
+
+    Files stay open between the calls reading them, so the number of
+    files in progress is bounded by max_open_files as well, by default by
+    FHUtils.open_files_limit(). Coroutines hold open_files while they keep
+    a file open, and each function run as a whole counts as one open file.
+    '''
+    def __init__(self, max_workers=None, max_open_files=None):
+        max_workers = max_workers or INITIAL_LIMIT
+        self._max_open_files = max_open_files or open_files_limit()
+        self._open_files = None
+        self._io = ThreadPoolExecutor(max_workers=max_workers,
+                                      thread_name_prefix='FHAsyncIO')
+        self._limiter = AdaptiveLimiter(max_workers)
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+        self._shutdown = False
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        # Created in the thread of the loop, which is the only one using it
+        self._open_files = asyncio.Semaphore(self._max_open_files)
+        self._loop.run_forever()
+        self._loop.close()
+
+    @property
+    def limit(self):
+        '''
+        Current limit of operations in flight.
+        '''
+        return self._limiter.limit
+
+    @property
+    def open_files(self):
+        '''
+        Semaphore to hold while a coroutine keeps a file open.
+        '''
+        return self._open_files
+
+    async def call(self, fn, *args):
+        '''
+        Run a blocking call of a coroutine, e.g. a read of one chunk, on an
+        I/O thread. Its latency adapts the limit.
+        '''
+        await self._limiter.acquire()
+        latency = None
+        try:
+            result, latency = await self._loop.run_in_executor(
+                self._io, _timed, fn, args)
+            return result
+        finally:
+            self._limiter.release(latency)
+
+    def start(self, fn, *args):
+        '''
+        Start call() without waiting for it, e.g. to read the next chunk of
+        a file while the current one is hashed.
+        '''
+        return self._loop.create_task(self.call(fn, *args))
+
+    async def _call_whole(self, fn, args, kwargs):
+        async with self._open_files:
+            await self._limiter.acquire()
+            try:
+                return await self._loop.run_in_executor(
+                    self._io, lambda: fn(*args, **kwargs))
+            finally:
+                self._limiter.release()
+
+    def submit(self, fn, /, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        if iscoroutinefunction(fn):
+            coroutine = fn(*args, **kwargs)
+        else:
+            coroutine = self._call_whole(fn, args, kwargs)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def _drain(self):
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        while tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            tasks = [task for task in asyncio.all_tasks()
+                     if task is not current]
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if self._shutdown:
+            return
+        self._shutdown = True
+        if wait:
+            asyncio.run_coroutine_threadsafe(self._drain(),
+                                             self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if wait:
+            self._thread.join()
+        self._io.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -0,0 +1,90 @@
+# coding=utf-8
+import sqlite3
+from threading import Lock
+from time import time
+
+# Entries not seen by any scan for this number of seconds are removed
+MAX_AGE = 30 * 24 * 3600
+
+# Number of entries written to the database in one transaction
+BATCH_SIZE = 1000
+
+
+class HashCache:
+    '''
+    On-disk SQLite cache of file hashes for incremental rescans. Entries are
+    separated by hash algorithm, identified by the device and inode of a file
+    and only used while its size and modification time stay the same.
+    '''
+    def __init__(self, filename, hash_alg):
+        self._hash_alg = hash_alg
+        self._scan_time = int(time())
+        self._updates = []
+        self._lock = Lock()
+
+        # One connection is shared by all worker threads and guarded by the
+        # lock; WAL mode lets several FileHasher processes use the same cache
+        self._db = sqlite3.connect(filename, timeout=60,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+            alg TEXT NOT NULL,
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            partial_hash BLOB,
+            hash BLOB,
+            ftype TEXT,
+            seen INTEGER NOT NULL,
+            PRIMARY KEY (alg, dev, ino))''')
+        self._db.commit()
+
+    def get(self, file):
+        '''
+        Return (partial_hash, digest, ftype) stored for an unchanged file or
+        None.
+        '''
+        dev, ino = file.file_id
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime_ns, partial_hash, hash, ftype '
+                'FROM hashes WHERE alg = ? AND dev = ? AND ino = ?',
+                (self._hash_alg, dev, ino)).fetchone()
+
+        if row is None or row[0] != file.size or row[1] != file.mtime_ns:
+            return None
+        return row[2:]
+
+    def put(self, file):
+        '''
+        Queue the file hashes for writing. Entries are written in batches.
+        '''
+        dev, ino = file.file_id
+        entry = (self._hash_alg, dev, ino, file.size, file.mtime_ns,
+                 file.partial_hash, file.digest, file.ftype, self._scan_time)
+        with self._lock:
+            self._updates.append(entry)
+            if len(self._updates) >= BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            self._updates)
+        self._db.commit()
+        self._updates = []
+
+    def close(self, completed=True):
+        '''
+        Write the queued entries, remove the stale ones after a completed
+        scan and close the cache.
+        '''
+        with self._lock:
+            self._flush()
+            if completed:
+                self._db.execute('DELETE FROM hashes WHERE seen < ?',
+                                 (self._scan_time - MAX_AGE,))
+                self._db.commit()
+            self._db.close()
@@ -0,0 +1,115 @@
+# coding=utf-8
+import sqlite3
+from os import path, sep
+from time import time
+
+from FHFile import FileRecord
+
+# Number of files written to the catalog in one transaction
+BATCH_SIZE = 1000
+
+
+class Catalog:
+    '''
+    Persistent SQLite catalog of the hashes of scanned files, indexed by
+    hash and by size. Later scans, e.g. of another volume, find the files
+    that already exist in the catalog without scanning it again.
+
+    The catalog is only used by the main thread of the scan.
+    '''
+    def __init__(self, filename, hash_alg):
+        self._hash_alg = hash_alg
+        self._scan_time = int(time())
+        self._updates = []
+        self._excluded = []
+
+        self._db = sqlite3.connect(filename, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS files (
+            path TEXT NOT NULL,
+            alg TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            hash BLOB NOT NULL,
+            scanned INTEGER NOT NULL,
+            PRIMARY KEY (path, alg))''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_hash '
+                         'ON files (alg, hash)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_size '
+                         'ON files (alg, size)')
+        self._db.commit()
+        self._load_sizes()
+
+    def _load_sizes(self):
+        # Sizes are checked for every scanned file, so they are kept in
+        # memory
+        self._sizes = {size for size, in self._db.execute(
+            'SELECT DISTINCT size FROM files WHERE alg = ?',
+            (self._hash_alg,))}
+
+    @staticmethod
+    def _ranges(folders):
+        for folder in folders:
+            folder = path.abspath(folder).rstrip(sep)
+            # All paths inside the folder sort between these two
+            yield folder, folder + sep, folder + chr(ord(sep) + 1)
+
+    def exclude(self, folders):
+        '''
+        Do not find the catalogued files of the folders about to be scanned,
+        they are found by the scan itself.
+        '''
+        self._excluded = [value for ranges in self._ranges(folders)
+                          for value in ranges]
+
+    def forget(self, folders):
+        '''
+        Remove the files of the folders, which are about to be scanned
+        again, from the catalog.
+        '''
+        for ranges in self._ranges(folders):
+            self._db.execute(
+                'DELETE FROM files WHERE alg = ? AND '
+                '(path = ? OR (path >= ? AND path < ?))',
+                (self._hash_alg,) + ranges)
+        self._db.commit()
+        self._load_sizes()
+
+    def has_size(self, size):
+        return size in self._sizes
+
+    def find(self, file):
+        '''
+        Return a record of a catalogued file outside the scanned folders
+        with the same contents as the hashed file or None.
+        '''
+        excluded = ' AND NOT (path = ? OR (path >= ? AND path < ?))' * (
+            len(self._excluded) // 3)
+        row = self._db.execute(
+            'SELECT path FROM files WHERE alg = ? AND hash = ?' + excluded +
+            ' LIMIT 1',
+            [self._hash_alg, file.digest] + self._excluded).fetchone()
+        if row is None:
+            return None
+        return FileRecord(row[0], file.size, digest=file.digest)
+
+    def add(self, file):
+        '''
+        Queue a hashed file for writing to the catalog. Files are written in
+        batches.
+        '''
+        self._updates.append((path.abspath(file.full_path), self._hash_alg,
+                              file.size, file.digest, self._scan_time))
+        if len(self._updates) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+            self._updates)
+        self._db.commit()
+        self._updates = []
+
+    def close(self):
+        self._flush()
+        self._db.close()
@@ -0,0 +1,118 @@
+# coding=utf-8
+import json
+from os import path, remove
+from threading import Lock
+from time import perf_counter
+
+# Number of records written to the checkpoint file at once
+BATCH_SIZE = 1000
+
+# Maximum number of seconds records wait in memory before being written
+FLUSH_INTERVAL = 10.0
+
+
+class Checkpoint:
+    '''
+    Append-only log of the hashes computed during a scan. If the scan is
+    interrupted, a new scan with the same checkpoint file takes the hashes of
+    files whose size and modification time have not changed from the log
+    instead of reading the files again.
+
+    The checkpoint is used by File like the hash cache and passes the
+    requests it cannot answer on to the hash cache, if there is one.
+    '''
+    def __init__(self, filename, hash_alg, cache=None):
+        self._filename = filename
+        self._hash_alg = hash_alg
+        self._cache = cache
+        self._records = {}
+        self._updates = []
+        self._flushed = perf_counter()
+        self._lock = Lock()
+
+        if path.isfile(filename):
+            self._load()
+
+        # A checkpoint without usable records, e.g. of a scan with another
+        # hash algorithm, is started anew
+        if self._records:
+            self._file = open(filename, 'a', encoding='utf-8')
+            # Do not continue a partially written last line
+            self._file.write('\n')
+        else:
+            self._file = open(filename, 'w', encoding='utf-8')
+            self._file.write(json.dumps({'alg': hash_alg}) + '\n')
+
+    def _load(self):
+        '''
+        Read the records of the interrupted scan. A partially written last
+        line is skipped.
+        '''
+        with open(self._filename, encoding='utf-8') as f:
+            header = f.readline()
+            try:
+                if json.loads(header).get('alg') != self._hash_alg:
+                    return
+            except ValueError:
+                return
+            for line in f:
+                try:
+                    full_path, size, mtime_ns, partial_hash, digest, ftype = \
+                        json.loads(line)
+                except ValueError:
+                    continue
+                self._records[full_path] = (
+                    size, mtime_ns,
+                    bytes.fromhex(partial_hash) if partial_hash else None,
+                    bytes.fromhex(digest) if digest else None,
+                    ftype)
+
+    def get(self, file):
+        '''
+        Return (partial_hash, digest, ftype) of an unchanged file or None.
+        '''
+        with self._lock:
+            record = self._records.pop(file.full_path, None)
+        if record is not None and record[0] == file.size \
+                and record[1] == file.mtime_ns:
+            return record[2:]
+        if self._cache is not None:
+            return self._cache.get(file)
+        return None
+
+    def put(self, file):
+        '''
+        Queue the file hashes for writing. Records are appended in batches.
+        '''
+        partial_hash, digest = file.partial_hash, file.digest
+        record = [file.full_path, file.size, file.mtime_ns,
+                  partial_hash.hex() if partial_hash else None,
+                  digest.hex() if digest else None,
+                  file.ftype]
+        with self._lock:
+            self._updates.append(record)
+            if len(self._updates) >= BATCH_SIZE \
+                    or perf_counter() - self._flushed > FLUSH_INTERVAL:
+                self._flush()
+        if self._cache is not None:
+            self._cache.put(file)
+
+    def _flush(self):
+        self._file.write(''.join(json.dumps(record) + '\n'
+                                 for record in self._updates))
+        self._file.flush()
+        self._updates = []
+        self._flushed = perf_counter()
+
+    def close(self, completed=True):
+        '''
+        Close the checkpoint. Once the scan is completed the checkpoint file
+        is not needed any more and is removed.
+        '''
+        with self._lock:
+            self._flush()
+            self._file.close()
+            if completed:
+                remove(self._filename)
+        if self._cache is not None:
+            self._cache.close(completed)
@@ -0,0 +1,214 @@
+# coding=utf-8
+from array import array
+from hashlib import blake2b
+from time import perf_counter
+from zlib import crc32
+
+from FHMetrics import counters
+
+# Chunks are cut where the content allows, but never shorter than
+# MIN_CHUNK_SIZE or longer than MAX_CHUNK_SIZE bytes
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+
+# A position is a cut candidate when the rolling hash of its last
+# ROLLING_WINDOW bytes is zero, one in 256 positions of random data. One in
+# CUT_MASK + 1 candidates, chosen by the CRC of the last CUT_WINDOW bytes,
+# becomes a cut, which makes chunks of about 8 KiB
+ROLLING_WINDOW = 3
+CUT_WINDOW = 48
+CUT_MASK = 31
+
+# Data is split in blocks of this size, so the temporary objects of the
+# rolling hash stay small even for memory-mapped files
+SPLIT_BLOCK_SIZE = 1024 * 1024
+
+# Size of a chunk fingerprint in bytes
+FINGERPRINT_SIZE = 8
+
+# Initial number of slots of the chunk index and the share of them that
+# may be used before it grows
+INITIAL_SLOTS = 1 << 16
+MAX_LOAD = 0.7
+
+
+def _byte_table(seed):
+    # Fixed random permutation of the byte values, the same in all
+    # processes and scans
+    return bytes(sorted(range(256), key=lambda value: blake2b(
+        bytes([seed, value]), digest_size=8).digest()))
+
+
+# Tables of the rolling hash, built for the first Chunker so that scans
+# without chunking do not pay for them at startup
+_tables = None
+
+
+def _get_tables():
+    global _tables
+    if _tables is None:
+        # Threads building them at once build the same tables
+        _tables = [_byte_table(seed) for seed in range(ROLLING_WINDOW)]
+    return _tables
+
+
+def _rolling_hash(data, tables):
+    '''
+    Return a byte for each position of the data: the XOR of its last
+    ROLLING_WINDOW bytes, each mapped by its own table. The whole block is
+    processed by big integer operations instead of a Python loop per byte.
+    '''
+    size = len(data)
+    value = 0
+    for shift, table in enumerate(tables):
+        # Byte i of the result gets byte i - shift of the data
+        value ^= int.from_bytes(data[:size - shift].translate(table), 'big')
+    return value.to_bytes(size, 'big')
+
+
+class Chunker:
+    '''
+    Hash object that also splits the hashed data into content-defined
+    chunks, so the chunks come from the same single read of a file as its
+    hash. A cut only depends on the bytes before it since the previous
+    cut, so an insertion shifts the following data without changing its
+    chunks.
+
+    Chunks are kept as compact arrays of their fingerprints and sizes.
+    '''
+    def __init__(self, hash_obj):
+        self._hash = hash_obj
+        self._tables = _get_tables()
+        self._rest = b''
+        self._fingerprints = array('Q')
+        self._sizes = array('I')
+
+    def update(self, data):
+        self._hash.update(data)
+        start = perf_counter()
+        with memoryview(data) as view:
+            view = view.cast('B')
+            for offset in range(0, len(view), SPLIT_BLOCK_SIZE):
+                self._split(view[offset:offset + SPLIT_BLOCK_SIZE])
+        counters.add('chunk_time', perf_counter() - start)
+
+    def digest(self):
+        return self._hash.digest()
+
+    def _add_chunk(self, chunk):
+        fingerprint = int.from_bytes(
+            blake2b(chunk, digest_size=FINGERPRINT_SIZE).digest(), 'big')
+        self._fingerprints.append(fingerprint)
+        self._sizes.append(len(chunk))
+
+    def _split(self, block):
+        # The rest of the previous block is split again with the new data;
+        # it is shorter than MAX_CHUNK_SIZE
+        data = self._rest + block
+        rolling = _rolling_hash(data, self._tables)
+        size = len(data)
+        start = 0
+        while True:
+            limit = start + MAX_CHUNK_SIZE
+            cut = rolling.find(0, start + MIN_CHUNK_SIZE - 1, limit)
+            while cut >= 0 and crc32(data[cut + 1 - CUT_WINDOW:cut + 1]) \
+                    & CUT_MASK:
+                cut = rolling.find(0, cut + 1, limit)
+            if cut >= 0:
+                end = cut + 1
+            elif limit <= size:
+                end = limit
+            else:
+                break
+            self._add_chunk(data[start:end])
+            start = end
+        self._rest = data[start:]
+
+    def chunks(self):
+        '''
+        Finish the last chunk and return the arrays of the chunk
+        fingerprints and sizes.
+        '''
+        if self._rest:
+            self._add_chunk(self._rest)
+            self._rest = b''
+        counters.add('chunks', len(self._sizes))
+        return self._fingerprints, self._sizes
+
+
+class ChunkIndex:
+    '''
+    Set of the fingerprints of all chunks seen by the scan, kept in an
+    open addressing table of 8-byte slots. It grows up to max_memory bytes;
+    after that only the chunks whose fingerprints fall into a sample,
+    halved each time the table fills up, are indexed, and the shared bytes
+    are estimated from them.
+
+    It is only used by the main thread.
+    '''
+    def __init__(self, max_memory):
+        self._max_slots = max(max_memory // FINGERPRINT_SIZE, INITIAL_SLOTS)
+        self._slots = array('Q', [0]) * INITIAL_SLOTS
+        self._used = 0
+        # Fingerprints below the limit are sampled; the shared bytes of the
+        # sample are scaled by 2 ** level
+        self._level = 0
+        self._sample_limit = 1 << (FINGERPRINT_SIZE * 8)
+
+    @property
+    def estimated(self):
+        return self._level > 0
+
+    @property
+    def memory(self):
+        return len(self._slots) * FINGERPRINT_SIZE
+
+    def add(self, fingerprints, sizes):
+        '''
+        Add the chunks of a file and return the number of its bytes in
+        chunks seen before, in other files or earlier in the same one.
+        '''
+        shared = 0
+        for fingerprint, size in zip(fingerprints, sizes):
+            if fingerprint >= self._sample_limit:
+                continue
+            if self._insert(fingerprint or 1):
+                shared += size
+        # Estimates of single files may exceed their size, they are only
+        # unbiased in total
+        return shared << self._level
+
+    def _insert(self, fingerprint):
+        '''
+        Add a non-zero fingerprint; return True if it was already there.
+        '''
+        slots = self._slots
+        mask = len(slots) - 1
+        i = fingerprint & mask
+        while True:
+            value = slots[i]
+            if value == fingerprint:
+                return True
+            if not value:
+                break
+            i = (i + 1) & mask
+        slots[i] = fingerprint
+        self._used += 1
+        if self._used > len(slots) * MAX_LOAD:
+            self._grow()
+        return False
+
+    def _grow(self):
+        old_slots = self._slots
+        count = len(old_slots)
+        if count * 2 <= self._max_slots:
+            count *= 2
+        else:
+            # No more memory: keep half of the sample
+            self._level += 1
+            self._sample_limit >>= 1
+        self._slots = array('Q', [0]) * count
+        self._used = 0
+        for fingerprint in old_slots:
+            if fingerprint and fingerprint < self._sample_limit:
+                self._insert(fingerprint)
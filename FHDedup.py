@@ -0,0 +1,425 @@
+# coding=utf-8
+from collections import deque
+from functools import partial
+from heapq import heappop, heappush
+from itertools import count
+from queue import SimpleQueue, Empty
+
+from FHFile import (MAX_COMPARED_FILES, PARTIAL_BLOCK_SIZE, ReadOptions,
+                    WaitingFiles, file_digest)
+from FHMetrics import counters
+from FHTypes import group_type
+from FHUtils import open_files_limit
+
+# Number of files submitted for hashing per worker thread before
+# the scan waits for some of them to complete
+PENDING_PER_WORKER = 64
+
+# Number of files hashed by a worker process in one task
+PROCESS_BATCH_SIZE = 16
+
+# Marks a group whose files have already been passed to the next stage
+_PROMOTED = object()
+
+
+class Deduplicator:
+    '''
+    Multi-stage search for duplicate candidates. Files are grouped by size,
+    files with a shared size are grouped by the partial hash of their first
+    and last bytes, and only the files that still collide are fully hashed.
+
+    With a thread pool files are hashed by their own methods. With a process
+    pool, batch_hasher(stage, paths) is submitted for batches of files and
+    returns compact (partial hash, digest, chunks) records for them.
+
+    With comparer(paths) given, files are not fully hashed one by one, but
+    compared byte by byte in groups of the same size and partial hash. A
+    comparer opens all files of its group at once, so at most
+    compare_limit groups are compared at once, by default as many as fit
+    into FHUtils.open_files_limit().
+
+    device_limits maps device numbers (st_dev) to the maximum number of
+    tasks reading files of the device at once; default_limit applies to
+    the other devices. Tasks over the limit wait in the main thread and,
+    with ordered=True, are started in the order of the inode numbers, which
+    roughly follows the placement of the files on the disk.
+
+    With coroutines=True the executor is an FHAsync.AsyncEngine and files
+    are hashed by coroutines reading them through it.
+
+    With counted=True batch_hasher and comparer return their records
+    together with the counters they added in a worker process, as done by
+    FHMetrics.run_counted.
+
+    With a catalog of earlier scans, files of a size found in the catalog
+    are fully hashed and looked up in it; a catalogued file with the same
+    contents becomes their original. With update_catalog=True all files
+    are hashed and added to the catalog.
+
+    With a chunk index, all files are hashed with chunking (see
+    ReadOptions) and their chunks are added to the index to count the
+    blocks they share with other files.
+    '''
+    def __init__(self, executor, result, max_pending=256, batch_hasher=None,
+                 comparer=None, device_limits=None, default_limit=None,
+                 ordered=False, counted=False, catalog=None,
+                 update_catalog=False, coroutines=False, chunk_index=None,
+                 compare_limit=None):
+        self._executor = executor
+        self._result = result
+        self._max_pending = max_pending
+        self._batch_hasher = batch_hasher
+        self._comparer = comparer
+        self._compare_groups = {}
+        self._compare_limit = compare_limit or max(
+            open_files_limit() // MAX_COMPARED_FILES, 1)
+        self._comparing = 0
+        self._compare_waiting = deque()
+        self._batches = {}
+        self._by_size = {}
+        self._waiting_files = WaitingFiles()
+        self._by_partial = {}
+        self._inodes = {}
+        self._done = SimpleQueue()
+        self._pending = 0
+        self._processed = 0
+        self._device_limits = device_limits or {}
+        self._default_limit = default_limit
+        self._ordered = ordered
+        self._running = {}
+        self._waiting = {}
+        self._task_ids = count()
+        self._counted = counted
+        self._catalog = catalog
+        self._update_catalog = update_catalog
+        self._coroutines = coroutines
+        self._chunk_index = chunk_index
+        # Files hashed without grouping them first
+        self._hash_all = update_catalog or chunk_index is not None
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def progress(self):
+        '''
+        Numbers of processed and all submitted hashing tasks, one per file
+        and stage.
+        '''
+        return self._processed, self._processed + self._pending
+
+    @staticmethod
+    def _group(groups, key, file):
+        '''
+        Put a file into its group and return the files to be passed to the
+        next stage: none for the first file of a group, both files for the
+        second one and just the file itself for all the following ones.
+        '''
+        first = groups.get(key)
+        if first is None:
+            groups[key] = file
+            return ()
+        if first is _PROMOTED:
+            return (file,)
+        groups[key] = _PROMOTED
+        return (first, file)
+
+    def _group_by_size(self, file):
+        '''
+        Put a file into its size group like _group(). The first file of
+        each size is kept in self._waiting_files, as most sizes are unique.
+        '''
+        first = self._by_size.get(file.size)
+        if first is None:
+            self._by_size[file.size] = self._waiting_files.add(file)
+            return ()
+        if first is _PROMOTED:
+            return (file,)
+        self._by_size[file.size] = _PROMOTED
+        return (self._waiting_files.pop(first, file), file)
+
+    def _device(self, file):
+        # Devices are only told apart when their tasks are limited
+        if not self._device_limits and not self._default_limit:
+            return None
+        return file.file_id[0]
+
+    def _run(self, stage, files, task, *args):
+        '''
+        Submit a task processing files of one device to the executor or, if
+        the device already runs as many tasks as allowed, keep it waiting
+        until one of them completes.
+        '''
+        device = self._device(files[0])
+        limit = self._device_limits.get(device, self._default_limit)
+        if limit:
+            running = self._running.get(device, 0)
+            if running >= limit:
+                order = files[0].file_id[1] if self._ordered else 0
+                heappush(self._waiting.setdefault(device, []),
+                         (order, next(self._task_ids), stage, files, task,
+                          args))
+                return
+            self._running[device] = running + 1
+
+        future = self._executor.submit(task, *args)
+        future.add_done_callback(
+            lambda f: self._done.put((stage, files, f, device)))
+
+    def _release(self, device):
+        '''
+        Start the next waiting task of a device whose task has completed.
+        '''
+        if device not in self._running:
+            return
+        self._running[device] -= 1
+        waiting = self._waiting.get(device)
+        if waiting:
+            _, _, stage, files, task, args = heappop(waiting)
+            self._run(stage, files, task, *args)
+
+    def _submit(self, stage, file):
+        # Files hashed without grouping need their own hash, they are not
+        # compared
+        if stage == 'full' and self._comparer is not None:
+            key = (file.size, file.partial_hash)
+            self._compare_groups.setdefault(key, []).append(file)
+            return
+
+        self._pending += 1
+
+        if self._coroutines:
+            if stage == 'partial':
+                self._run(stage, (file,), file.set_partial_hash_async,
+                          self._executor)
+            else:
+                self._run(stage, (file,), file.set_file_data_async,
+                          self._executor)
+
+        elif self._batch_hasher is None:
+            if stage == 'partial':
+                self._run(stage, (file,), file.set_partial_hash)
+            else:
+                self._run(stage, (file,), file.set_file_data)
+
+        # Worker processes have no access to the hash cache
+        elif file.has_cached_hash(partial=(stage == 'partial')):
+            self._done.put((stage, (file,), None, None))
+
+        else:
+            # Batches are made per device, so they can be limited as well
+            key = (stage, self._device(file))
+            batch = self._batches.setdefault(key, [])
+            batch.append(file)
+            if len(batch) >= PROCESS_BATCH_SIZE:
+                self._submit_batch(key)
+
+    def _submit_batch(self, key):
+        files = self._batches.pop(key)
+        stage = key[0]
+        self._run(stage, files, self._batch_hasher, stage,
+                  [file.full_path for file in files])
+
+    def _submit_size_candidate(self, file):
+        # For small files a partial hash would read as much as a full one
+        if file.size > 2 * PARTIAL_BLOCK_SIZE:
+            self._submit('partial', file)
+        else:
+            self._submit('full', file)
+
+    def add_file(self, file):
+        '''
+        Count a found file and, if another file of the same size was
+        already found, start hashing it.
+        '''
+        # Hardlinks share the contents of the first found path of their
+        # inode: only that path is hashed, the others are counted apart.
+        # Without a link count from the walk, as on Windows, it is only
+        # looked up for the files to be hashed
+        if file.links > 1 and self._is_hardlink(file):
+            return
+
+        self._result.add_file(file)
+        if not file.size:
+            return
+        if self._hash_all or (self._catalog is not None
+                              and self._catalog.has_size(file.size)):
+            if not self._is_late_hardlink(file):
+                self._submit('direct', file)
+        else:
+            for candidate in self._group_by_size(file):
+                if not self._is_late_hardlink(candidate):
+                    self._submit_size_candidate(candidate)
+
+        # Do not let the executor queue grow unbounded
+        while self._pending >= self._max_pending:
+            self.collect(block=True)
+
+    def _is_hardlink(self, file, counted=False):
+        '''
+        Count a file as a hardlink and return True if it is another path of
+        an inode found before. With counted=True the file was already
+        counted as a file.
+        '''
+        # file_id stats the file if the walk gave no link count
+        file_id = file.file_id
+        if file.links <= 1:
+            return False
+        first_path = self._inodes.setdefault(file_id, file.full_path)
+        if first_path == file.full_path:
+            return False
+        self._result.add_hardlink(first_path, file, counted=counted)
+        return True
+
+    def _is_late_hardlink(self, file):
+        # Files with a link count from the walk were checked when added
+        return not file.links and self._is_hardlink(file, counted=True)
+
+    def collect(self, block=False):
+        '''
+        Pass hashed files to their next stage. With block=True wait until
+        at least one file is ready. Return the number of processed files.
+        '''
+        # Files waiting in incomplete batches would never be ready
+        if block:
+            for key in list(self._batches):
+                self._submit_batch(key)
+
+        processed = 0
+        while self._pending:
+            try:
+                stage, files, future, device = self._done.get(
+                    block=block and not processed)
+            except Empty:
+                break
+            self._release(device)
+            if stage == 'compare':
+                self._comparing -= 1
+                self._start_compared()
+            self._pending -= len(files)
+            self._processed += len(files)
+            processed += len(files)
+
+            records = future.result() if future is not None else None
+            if records is not None and self._counted:
+                records, task_counters = records
+                counters.update(task_counters)
+            if records is not None:
+                for file, record in zip(files, records):
+                    file.set_hashes(*record)
+
+            for file in files:
+                if stage == 'partial':
+                    if file.partial_hash is not None:
+                        key = (file.size, file.partial_hash)
+                        for candidate in self._group(self._by_partial, key,
+                                                     file):
+                            self._submit('full', candidate)
+                    continue
+                if stage == 'direct':
+                    self._check_catalog(file)
+                    self._add_chunks(file)
+                self._result.add_hashed_file(file)
+        return processed
+
+    def _check_catalog(self, file):
+        '''
+        Make a catalogued file with the same contents the original of a
+        hashed file and add the file to the catalog if it is updated.
+        '''
+        if self._catalog is None or file.digest is None:
+            return
+        known = self._catalog.find(file)
+        if known is not None:
+            self._result.add_known_file(known)
+        if self._update_catalog:
+            self._catalog.add(file)
+
+    def _add_chunks(self, file):
+        '''
+        Count the bytes of a hashed file in chunks seen before.
+        '''
+        if self._chunk_index is None or file.chunks is None:
+            return
+        shared_size = self._chunk_index.add(*file.chunks)
+        self._result.add_chunked_file(file, shared_size,
+                                      self._chunk_index.estimated)
+
+    def submit_compared(self):
+        '''
+        Submit the collected candidate groups for byte-by-byte comparison.
+        It must be called once all members of the groups are known, i.e.
+        after the walk and the partial hashing. Returns the number of
+        submitted files.
+        '''
+        submitted = 0
+        for files in self._compare_groups.values():
+            if len(files) < 2:
+                continue
+            self._pending += len(files)
+            submitted += len(files)
+
+            if all(file.has_cached_hash() for file in files):
+                self._done.put(('full', files, None, None))
+                continue
+            self._compare_waiting.append(files)
+
+        self._compare_groups = {}
+        self._start_compared()
+        return submitted
+
+    def _start_compared(self):
+        '''
+        Start comparing the waiting groups as long as the limit of groups
+        compared at once allows.
+        '''
+        while self._compare_waiting \
+                and self._comparing < self._compare_limit:
+            files = self._compare_waiting.popleft()
+            self._comparing += 1
+            self._run('compare', files, self._comparer,
+                      [file.full_path for file in files])
+
+    def verify(self, hash_alg='sha256', read_options=ReadOptions()):
+        '''
+        Rehash the found duplicates and their originals with a strong hash
+        algorithm and regroup the files of each group by their new digests,
+        dropping the files that cannot be read or match no other file.
+        '''
+        groups = [(orig, list(duplicates))
+                  for _, orig, duplicates in self._result.get_groups()]
+        paths = [file.full_path for orig, duplicates in groups
+                 for file in (orig, *duplicates)]
+        digests = dict(zip(paths, self._executor.map(
+            partial(file_digest, hash_alg=hash_alg,
+                    read_options=read_options), paths,
+            chunksize=PROCESS_BATCH_SIZE)))
+
+        for orig, duplicates in groups:
+            # The original may have changed or be unreadable, e.g. an
+            # offline catalogued file, while its duplicates still match
+            by_digest = {}
+            for file in (orig, *duplicates):
+                digest = digests[file.full_path]
+                if digest is not None:
+                    by_digest.setdefault(digest, []).append(file)
+            regrouped = list(by_digest.values())
+            # Nothing changes while all files still match
+            if len(regrouped) != 1 or len(regrouped[0]) <= len(duplicates):
+                self._result.regroup(orig.digest, regrouped)
+
+    def detect_types(self):
+        '''
+        Detect the type of each group of duplicates once, from the first of
+        its files that can be read, and set it for all files of the group.
+        '''
+        groups = [(orig, duplicates)
+                  for _, orig, duplicates in self._result.get_groups()]
+        paths = [[file.full_path for file in (orig, *duplicates)]
+                 for orig, duplicates in groups]
+        types = self._executor.map(group_type, paths,
+                                   chunksize=PROCESS_BATCH_SIZE)
+        for (orig, duplicates), ftype in zip(groups, types):
+            for file in (orig, *duplicates):
+                file.ftype = ftype
@@ -0,0 +1,138 @@
+# coding=utf-8
+import csv
+import json
+from importlib.util import find_spec
+from os import path
+from threading import Lock
+
+# Columns of the exported files: the columns of the Detailed sheet with
+# the size in bytes, plus the ID of the duplicate group
+COLUMNS = ('group', 'original', 'duplicate', 'size', 'hash', 'type')
+
+# Number of rows after which the written data is flushed to the disk, so
+# the file stays usable if the scan is interrupted
+FLUSH_ROWS = 1000
+
+# Number of rows in one Parquet row group
+PARQUET_ROW_GROUP = 65536
+
+
+class Exporter:
+    '''
+    Writes duplicate rows to a file as soon as they are found. Rows may be
+    added from several threads at once.
+    '''
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = Lock()
+        self._rows = 0
+
+    def add_row(self, group_id, orig, dup):
+        row = (group_id, orig.full_path, dup.full_path, dup.size, dup.hash,
+               dup.ftype)
+        with self._lock:
+            self._write(row)
+            self._rows += 1
+            if self._rows % FLUSH_ROWS == 0:
+                self._flush()
+
+    def _write(self, row):
+        raise NotImplementedError
+
+    def _flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class CsvExporter(Exporter):
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._file = open(filename, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(COLUMNS)
+
+    def _write(self, row):
+        self._writer.writerow(row)
+
+    def _flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class JsonLinesExporter(Exporter):
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._file = open(filename, 'w', encoding='utf-8')
+
+    def _write(self, row):
+        self._file.write(json.dumps(dict(zip(COLUMNS, row)),
+                                    ensure_ascii=False))
+        self._file.write('\n')
+
+    def _flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetExporter(Exporter):
+    '''
+    Writes rows in row groups. Unlike CSV and JSON Lines, a Parquet file is
+    only readable after it is closed.
+    '''
+    def __init__(self, filename):
+        super().__init__(filename)
+        # pyarrow takes long to import, so it is only loaded when needed
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([
+            ('group', pyarrow.int64()),
+            ('original', pyarrow.string()),
+            ('duplicate', pyarrow.string()),
+            ('size', pyarrow.int64()),
+            ('hash', pyarrow.string()),
+            ('type', pyarrow.string()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema)
+        self._buffer = []
+
+    def _write(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= PARQUET_ROW_GROUP:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        if self._buffer:
+            columns = [list(column) for column in zip(*self._buffer)]
+            self._writer.write_table(
+                self._pyarrow.Table.from_arrays(columns,
+                                                schema=self._schema))
+            self._buffer = []
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+
+
+EXPORTERS = {
+    '.csv': CsvExporter,
+    '.jsonl': JsonLinesExporter,
+}
+if find_spec('pyarrow') is not None:
+    EXPORTERS['.parquet'] = ParquetExporter
+
+
+def get_exporter(filename):
+    '''
+    Return an exporter for the file extension or None for Excel reports.
+    '''
+    exporter_class = EXPORTERS.get(path.splitext(filename)[1].lower())
+    if exporter_class is None:
+        return None
+    return exporter_class(filename)
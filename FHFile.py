@@ -1,32 +1,180 @@
 # coding=utf-8
-from hashlib import sha1, md5
-from os import stat
-import magic
+from array import array
+from collections import deque, namedtuple
+from errno import EMFILE, ENFILE
+from mmap import mmap, ACCESS_READ
+from os import path, stat, SEEK_END
+from sys import intern
+from threading import local
+from time import perf_counter
 
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL, POSIX_FADV_DONTNEED
+except ImportError:
+    # Not available on Windows and macOS
+    posix_fadvise = None
+
+try:
+    from os import pread
+except ImportError:
+    # Not available on Windows
+    pread = None
+
+from FHChunks import Chunker
+from FHHashers import get_hasher
+from FHMetrics import counters
 from FHUtils import human_readable_size
 
+# Number of bytes read from the beginning and from the end of a file
+# to compute its partial hash
+PARTIAL_BLOCK_SIZE = 16 * 1024
 
-class File:
-    def __init__(self, full_file_path, hash_alg='sha1', check_type=False):
-        self._full_file_path = full_file_path
-        self._file_size = 0
-        self._file_ctime = None
-        self._file_type = None
-        self._hash = None
-        self._check_type = check_type
+# Size of the chunks read from each file when files are compared byte by byte
+COMPARE_CHUNK_SIZE = 1024 * 1024
 
-        self._set_file_size()
-        self._set_file_ctime()
+# Maximum number of files compared at once; larger groups are hashed
+MAX_COMPARED_FILES = 16
+
+# Number of chunks of a file read at once by the 'async' I/O engine
+ASYNC_READ_AHEAD = 4
+
+# Files smaller than this are read even with the 'mmap' I/O engine
+MMAP_MIN_SIZE = 4 * 1024 * 1024
+
+# How files are read for full hashing:
+#   engine       'read' (new bytes object for each chunk), 'readinto'
+#                (reusable buffer), 'mmap' (whole file mapped into memory)
+#                or 'async' (chunks read by FHAsync.AsyncEngine)
+#   buffer_size  size of the chunks in bytes
+#   drop_cache   advise the OS to drop the read data from the page cache
+#   chunking     split the files into content-defined chunks while they are
+#                hashed, to find the blocks they share (FHChunks)
+ReadOptions = namedtuple('ReadOptions',
+                         ['engine', 'buffer_size', 'drop_cache', 'chunking'],
+                         defaults=['readinto', 256 * 1024, False, False])
+
+# Stat fields of a file kept by WaitingFiles
+_WaitingStat = namedtuple('_WaitingStat',
+                          ['st_size', 'st_ctime', 'st_mtime_ns', 'st_dev',
+                           'st_ino', 'st_nlink'])
+
+# Read buffers reused by the worker threads
+_buffers = local()
+
+
+def _get_buffer(size):
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+
+def _advise(f, advice_name):
+    if posix_fadvise is not None:
+        advice = {'sequential': POSIX_FADV_SEQUENTIAL,
+                  'dontneed': POSIX_FADV_DONTNEED}[advice_name]
+        try:
+            posix_fadvise(f.fileno(), 0, 0, advice)
+        except OSError:
+            pass
+
+
+def _check_open_files(error):
+    '''
+    Re-raise an error of the process or the system running out of open
+    files: the file itself may be readable, it must not be skipped as an
+    unreadable one.
+    '''
+    if getattr(error, 'errno', None) in (EMFILE, ENFILE):
+        raise error
+
+
+def _read_head_tail(full_path, file_size):
+    '''
+    Read the first and the last PARTIAL_BLOCK_SIZE bytes of a file; the
+    tail is empty for files that are not longer than both of them.
+    '''
+    tail = b''
+    with open(full_path, 'rb') as f:
+        head = f.read(PARTIAL_BLOCK_SIZE)
+        if file_size > 2 * PARTIAL_BLOCK_SIZE:
+            f.seek(-PARTIAL_BLOCK_SIZE, SEEK_END)
+            tail = f.read(PARTIAL_BLOCK_SIZE)
+    return head, tail
 
-        if hash_alg == 'sha1':
-            self._hash_alg = sha1()
-        else:
-            self._hash_alg = md5()
-        self._block_size = self._hash_alg.block_size * 1024
+
+# The blocking calls of the 'async' I/O engine. Each call is one operation
+# of the engine, so a file is opened and its first chunk read in one call,
+# and small files are closed in it as well
+
+def _open_and_read(full_path, size, drop_cache):
+    '''
+    Open a file and read its first chunk. Return the open file, or None if
+    the chunk was all of it, and the chunk.
+    '''
+    f = open(full_path, 'rb', buffering=0)
+    try:
+        _advise(f, 'sequential')
+        chunk = f.read(size)
+    except BaseException:
+        f.close()
+        raise
+    if len(chunk) < size:
+        _close(f, drop_cache)
+        return None, chunk
+    return f, chunk
+
+
+def _close(f, drop_cache):
+    if drop_cache:
+        _advise(f, 'dontneed')
+    f.close()
+
+
+def _read_at(f, offset, size):
+    # Without pread the chunks of a file are read one at a time
+    if pread is None:
+        f.seek(offset)
+        return f.read(size)
+    return pread(f.fileno(), size, offset)
+
+
+async def _settle(reads):
+    '''
+    Wait for the reads of a file still in flight, so the file is only
+    closed once no read uses it.
+    '''
+    for reading in reads:
+        try:
+            await reading
+        except OSError:
+            pass
+
+
+class FileRecord:
+    '''
+    Compact record of a hashed file. The folder part of the path is shared
+    by all files of a folder and the hash is kept as raw bytes.
+    '''
+    __slots__ = ('_folder', '_name', '_file_size', '_file_ctime', '_hash',
+                 '_file_type')
+
+    def __init__(self, full_file_path, file_size=0, file_ctime=None,
+                 digest=None, file_type=None):
+        folder, self._name = path.split(full_file_path)
+        self._folder = intern(folder)
+        self._file_size = file_size
+        self._file_ctime = file_ctime
+        self._hash = digest
+        self._file_type = file_type
 
     @property
     def full_path(self):
-        return self._full_file_path
+        return path.join(self._folder, self._name)
+
+    @property
+    def folder(self):
+        return self._folder
 
     @property
     def size(self):
@@ -36,61 +184,534 @@ class File:
     def hr_size(self):
         return human_readable_size(self._file_size)
 
-    def _set_file_size(self):
-        try:
-            self._file_size = stat(self._full_file_path).st_size
-        except OSError:
-            self._file_size = 0
-
     @property
     def ctime(self):
         return self._file_ctime
 
-    def _set_file_ctime(self):
-        try:
-            self._file_ctime = stat(self._full_file_path).st_ctime
-        except OSError:
-            self._file_ctime = None
+    @property
+    def digest(self):
+        return self._hash
 
     @property
     def hash(self):
-        return self._hash
+        if self._hash is None:
+            return None
+        return self._hash.hex()
 
     @property
     def ftype(self):
         return self._file_type
 
+    @ftype.setter
+    def ftype(self, file_type):
+        self._file_type = file_type
+
+    def __str__(self):
+        return self.full_path
+
+
+class File(FileRecord):
+    __slots__ = ('_file_mtime_ns', '_file_dev', '_file_ino', '_file_links',
+                 '_partial_hash', '_cache', '_cache_loaded', '_read_options',
+                 '_hash_alg', '_chunks')
+
+    def __init__(self, full_file_path, hash_alg='sha1', file_stat=None,
+                 cache=None, read_options=ReadOptions()):
+        super().__init__(full_file_path)
+        self._file_mtime_ns = None
+        self._file_dev = 0
+        self._file_ino = 0
+        self._file_links = 1
+        self._partial_hash = None
+        self._cache = cache
+        self._cache_loaded = False
+        self._read_options = read_options
+        self._chunks = None
+
+        self._set_file_stat(file_stat)
+
+        # Only the constructor is kept, hash objects live while a file is read
+        self._hash_alg = get_hasher(hash_alg)
+
+    def record(self):
+        return FileRecord(self.full_path, self._file_size, self._file_ctime,
+                          self._hash, self._file_type)
+
+    def sibling(self, full_file_path, file_stat):
+        '''
+        Make a file of another path, hashed, cached and read like this one.
+        '''
+        file = File(full_file_path, file_stat=file_stat, cache=self._cache,
+                    read_options=self._read_options)
+        file._hash_alg = self._hash_alg
+        return file
+
+    @property
+    def mtime_ns(self):
+        return self._file_mtime_ns
+
+    @property
+    def links(self):
+        '''
+        Number of hardlinks to the file, 0 while it is not known: on Windows
+        it is only set by the stat call of file_id.
+        '''
+        return self._file_links
+
+    @property
+    def file_id(self):
+        '''
+        Device and inode numbers of the file.
+        '''
+        # os.DirEntry.stat() leaves them and the link count empty on Windows
+        if not self._file_ino:
+            self._set_file_stat()
+        return self._file_dev, self._file_ino
+
+    def _set_file_stat(self, file_stat=None):
+        '''
+        Set the file size and creation time from a stat result, e.g. the one
+        cached by os.DirEntry, or from a new stat call.
+        '''
+        if file_stat is None:
+            try:
+                file_stat = stat(self.full_path)
+            except OSError:
+                return
+        self._file_size = file_stat.st_size
+        self._file_ctime = file_stat.st_ctime
+        self._file_mtime_ns = file_stat.st_mtime_ns
+        self._file_dev = file_stat.st_dev
+        self._file_ino = file_stat.st_ino
+        self._file_links = file_stat.st_nlink
+
+    @property
+    def partial_hash(self):
+        return self._partial_hash
+
+    @property
+    def chunks(self):
+        '''
+        Arrays of the fingerprints and sizes of the content-defined chunks
+        of the file, if it was read with chunking.
+        '''
+        return self._chunks
+
+    def _new_hash(self):
+        # With chunking the hash object splits the data into chunks as well
+        hash_obj = self._hash_alg()
+        if self._read_options.chunking:
+            return Chunker(hash_obj)
+        return hash_obj
+
+    def _set_digest(self, hash_obj):
+        self._hash = hash_obj.digest()
+        if self._read_options.chunking:
+            self._chunks = hash_obj.chunks()
+
+    def _needs_full_hash(self):
+        # Hashes from the cache have no chunks
+        return self._hash is None or (self._read_options.chunking
+                                      and self._chunks is None)
+
     def _process_file(self):
         '''
-        Compute hash and optionally detect file type in one file read.
+        Compute the hash of the whole file.
         '''
+        hash_alg = self._new_hash()
+        options = self._read_options
         try:
-            with open(self._full_file_path, 'rb') as f:
-                # Read the initial header (enough for type detection)
-                header = f.read(2048)
+            # The file is read unbuffered, the chunks are big enough
+            with open(self.full_path, 'rb', buffering=0) as f:
+                _advise(f, 'sequential')
+                if options.engine == 'mmap' \
+                        and self._file_size >= MMAP_MIN_SIZE:
+                    stats = self._hash_mmap(f, hash_alg)
+                elif options.engine == 'read':
+                    stats = self._hash_read(f, hash_alg, options.buffer_size)
+                else:
+                    stats = self._hash_readinto(f, hash_alg,
+                                                options.buffer_size)
+                if options.drop_cache:
+                    _advise(f, 'dontneed')
 
-                # Detect file type if enabled
-                if self._check_type:
-                    try:
-                        self._file_type = magic.from_buffer(header, mime=False)
-                    except magic.MagicException:
-                        self._file_type = None
+            self._set_digest(hash_alg)
+
+            read_bytes, read_time, hash_time = stats
+            counters.add('hashed_files', 1)
+            counters.add('read_bytes', read_bytes)
+            counters.add('read_time', read_time)
+            counters.add('hash_time', hash_time)
 
-                # Feed the header into the hash algorithm
-                self._hash_alg.update(header)
+        except (OSError, ValueError) as e:
+            _check_open_files(e)
+            self._hash = None
+
+    # The _hash_* methods return the number of read bytes and the time
+    # spent reading and hashing them
+
+    def _hash_read(self, f, hash_alg, buffer_size):
+        start = perf_counter()
+        chunk = f.read(buffer_size)
+        read_time = perf_counter() - start
+        hash_time = 0.0
+        read_bytes = 0
+        while chunk:
+            start = perf_counter()
+            hash_alg.update(chunk)
+            hashed = perf_counter()
+            hash_time += hashed - start
+            read_bytes += len(chunk)
+            chunk = f.read(buffer_size)
+            read_time += perf_counter() - hashed
+        return read_bytes, read_time, hash_time
 
-                # Continue reading and hashing the rest of the file
-                for chunk in iter(lambda: f.read(self._block_size), b''):
-                    self._hash_alg.update(chunk)
+    def _hash_readinto(self, f, hash_alg, buffer_size):
+        # Chunks are read into the same buffer without creating new objects
+        buffer = _get_buffer(buffer_size)
+        hash_time = 0.0
+        read_bytes = 0
+        with memoryview(buffer) as view:
+            start = perf_counter()
+            size = f.readinto(buffer)
+            read_time = perf_counter() - start
+            while size:
+                start = perf_counter()
+                hash_alg.update(view[:size])
+                hashed = perf_counter()
+                hash_time += hashed - start
+                read_bytes += size
+                size = f.readinto(buffer)
+                read_time += perf_counter() - hashed
+        return read_bytes, read_time, hash_time
 
-            self._hash = self._hash_alg.hexdigest()
+    def _hash_mmap(self, f, hash_alg):
+        # The whole file is hashed in one call, hash functions release
+        # the GIL for such large buffers
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as mapped:
+            # The pages are read while they are hashed, so the reading
+            # time cannot be told apart
+            start = perf_counter()
+            hash_alg.update(mapped)
+            return len(mapped), 0.0, perf_counter() - start
 
-        except (OSError, ValueError):
+    async def _process_file_async(self, engine):
+        '''
+        Compute the hash of the whole file, reading it through the asyncio
+        engine. After the first chunk, up to ASYNC_READ_AHEAD chunks are
+        read at once and hashed in order as they arrive.
+        '''
+        hash_alg = self._new_hash()
+        try:
+            # The file stays open between the reads of its chunks
+            async with engine.open_files:
+                stats = await self._hash_async(engine, hash_alg)
+            self._set_digest(hash_alg)
+
+            read_bytes, read_time, hash_time = stats
+            counters.add('hashed_files', 1)
+            counters.add('read_bytes', read_bytes)
+            counters.add('read_time', read_time)
+            counters.add('hash_time', hash_time)
+
+        except (OSError, ValueError) as e:
+            _check_open_files(e)
             self._hash = None
-            self._file_type = None
+
+    async def _hash_async(self, engine, hash_alg):
+        buffer_size = self._read_options.buffer_size
+        drop_cache = self._read_options.drop_cache
+        window = ASYNC_READ_AHEAD if pread is not None else 1
+
+        # Only the time spent waiting for the data is counted, reads hidden
+        # behind hashing take none
+        start = perf_counter()
+        f, chunk = await engine.call(_open_and_read, self.full_path,
+                                     buffer_size, drop_cache)
+        hashed = perf_counter()
+        read_time = hashed - start
+        hash_alg.update(chunk)
+        hash_time = perf_counter() - hashed
+        read_bytes = len(chunk)
+
+        reads = deque()
+        offset = buffer_size
+        try:
+            while f is not None:
+                # Chunks are requested up to the end of the file known from
+                # its stat; the read at the end confirms it, or more chunks
+                # are requested if the file has grown
+                while len(reads) < window and (
+                        not reads or offset <= self._file_size):
+                    reads.append(engine.start(_read_at, f, offset,
+                                              buffer_size))
+                    offset += buffer_size
+                start = perf_counter()
+                chunk = await reads.popleft()
+                hashed = perf_counter()
+                read_time += hashed - start
+                hash_alg.update(chunk)
+                hash_time += perf_counter() - hashed
+                read_bytes += len(chunk)
+                if len(chunk) < buffer_size:
+                    break
+        finally:
+            if f is not None:
+                await _settle(reads)
+                await engine.call(_close, f, drop_cache)
+        return read_bytes, read_time, hash_time
+
+    def _process_partial(self):
+        '''
+        Compute a cheap hash of the first and the last PARTIAL_BLOCK_SIZE
+        bytes of the file.
+        '''
+        hash_alg = self._hash_alg()
+        start = perf_counter()
+        try:
+            head, tail = _read_head_tail(self.full_path, self._file_size)
+            hash_alg.update(head)
+            hash_alg.update(tail)
+            self._partial_hash = hash_alg.digest()
+
+            # Hashing the few read bytes takes no noticeable time
+            counters.add('partial_files', 1)
+            counters.add('read_bytes', len(head) + len(tail))
+            counters.add('read_time', perf_counter() - start)
+
+        except (OSError, ValueError) as e:
+            _check_open_files(e)
+            self._partial_hash = None
+
+    async def _process_partial_async(self, engine):
+        '''
+        Compute the partial hash, reading the file through the asyncio
+        engine in one call.
+        '''
+        hash_alg = self._hash_alg()
+        start = perf_counter()
+        try:
+            async with engine.open_files:
+                head, tail = await engine.call(_read_head_tail,
+                                               self.full_path,
+                                               self._file_size)
+            hash_alg.update(head)
+            hash_alg.update(tail)
+            self._partial_hash = hash_alg.digest()
+
+            counters.add('partial_files', 1)
+            counters.add('read_bytes', len(head) + len(tail))
+            counters.add('read_time', perf_counter() - start)
+
+        except (OSError, ValueError) as e:
+            _check_open_files(e)
+            self._partial_hash = None
+
+    def _load_from_cache(self):
+        '''
+        Take the hashes computed by a previous scan from the hash cache if the
+        file has not been changed since then.
+        '''
+        if self._cache is None or self._cache_loaded:
+            return
+        self._cache_loaded = True
+
+        cached = self._cache.get(self)
+        if cached is None:
+            return
+        counters.add('cached_files', 1)
+        # File types are only detected for duplicates, after the scan
+        self._partial_hash, self._hash, _ = cached
+
+    def _save_to_cache(self):
+        if self._cache is not None and (self._hash or self._partial_hash):
+            self._cache.put(self)
+
+    def has_cached_hash(self, partial=False):
+        '''
+        Load the file hashes from the hash cache and tell whether the needed
+        one was found there.
+        '''
+        self._load_from_cache()
+        if partial and self._partial_hash is None:
+            return False
+        if not partial and self._needs_full_hash():
+            return False
+        self._save_to_cache()
+        return True
+
+    def set_hashes(self, partial_hash, digest, chunks=None):
+        '''
+        Set the hashes and chunks computed by a worker process.
+        '''
+        if partial_hash is not None:
+            self._partial_hash = partial_hash
+        if digest is not None:
+            self._hash = digest
+        if chunks is not None:
+            self._chunks = chunks
+        self._save_to_cache()
+
+    def set_partial_hash(self):
+        self._load_from_cache()
+        if self._partial_hash is None:
+            self._process_partial()
+        self._save_to_cache()
 
     def set_file_data(self):
-        self._process_file()
+        self._load_from_cache()
+        if self._needs_full_hash():
+            self._process_file()
+        self._save_to_cache()
 
-    def __str__(self):
-        return self.full_path
+    async def set_partial_hash_async(self, engine):
+        self._load_from_cache()
+        if self._partial_hash is None:
+            await self._process_partial_async(engine)
+        self._save_to_cache()
+
+    async def set_file_data_async(self, engine):
+        self._load_from_cache()
+        if self._needs_full_hash():
+            await self._process_file_async(engine)
+        self._save_to_cache()
+
+
+class WaitingFiles:
+    '''
+    Found files waiting for another file of their size, which is most files
+    of a tree. Only what is needed to make a File of them again is kept, in
+    arrays of their stat fields, instead of a File object for each.
+    '''
+    def __init__(self):
+        self._folders = []
+        self._names = []
+        self._ctimes = array('d')
+        self._mtimes = array('q')
+        self._devices = array('Q')
+        self._inodes = array('Q')
+        self._links = array('I')
+
+    def add(self, file):
+        '''
+        Keep a file and return its index.
+        '''
+        self._folders.append(file.folder)
+        self._names.append(file._name)
+        self._ctimes.append(file.ctime)
+        self._mtimes.append(file.mtime_ns)
+        self._devices.append(file._file_dev)
+        self._inodes.append(file._file_ino)
+        self._links.append(file.links)
+        return len(self._names) - 1
+
+    def pop(self, index, sibling):
+        '''
+        Make a File of a kept file, hashed like its sibling of the same
+        size. Only the path is freed, the stat fields stay in the arrays.
+        '''
+        folder, name = self._folders[index], self._names[index]
+        self._folders[index] = self._names[index] = None
+        file_stat = _WaitingStat(sibling.size, self._ctimes[index],
+                                 self._mtimes[index], self._devices[index],
+                                 self._inodes[index], self._links[index])
+        return sibling.sibling(path.join(folder, name), file_stat)
+
+
+def file_digest(full_path, hash_alg='sha256', read_options=ReadOptions()):
+    '''
+    Return the hex digest of a whole file or None if it cannot be read. It
+    is not counted in the scan counters.
+    '''
+    # The chunks are not needed to verify a hash
+    file = File(full_path, hash_alg=hash_alg,
+                read_options=read_options._replace(chunking=False))
+    with counters.excluded():
+        file.set_file_data()
+    return file.hash
+
+
+def hash_files(stage, paths, hash_alg='sha1', read_options=ReadOptions()):
+    '''
+    Compute partial or full hashes of a batch of files in a worker process.
+    Returns a compact (partial hash, digest, chunks) record for each path.
+    '''
+    records = []
+    for full_path in paths:
+        file = File(full_path, hash_alg=hash_alg, read_options=read_options)
+        if stage == 'partial':
+            file.set_partial_hash()
+        else:
+            file.set_file_data()
+        records.append((file.partial_hash, file.digest, file.chunks))
+    return records
+
+
+def compare_files(paths, hash_alg='sha1', read_options=ReadOptions()):
+    '''
+    Compare files of the same size byte by byte, reading them in lockstep,
+    and split them into groups as soon as their contents diverge. Only one
+    file of each group is hashed. Returns a (partial hash, hash) record for
+    each path; the hash is None for files with unique contents.
+    '''
+    if len(paths) > MAX_COMPARED_FILES:
+        return hash_files('full', paths, hash_alg, read_options)
+
+    records = [(None, None)] * len(paths)
+    files = {}
+    try:
+        for i, full_path in enumerate(paths):
+            try:
+                files[i] = open(full_path, 'rb')
+            except OSError as e:
+                _check_open_files(e)
+                continue
+            _advise(files[i], 'sequential')
+
+        # Each group is (indexes of the files, hash of the read part)
+        groups = [(list(files), get_hasher(hash_alg)())]
+        read_bytes = 0
+        read_time = hash_time = 0.0
+        while groups:
+            next_groups = []
+            for members, hash_obj in groups:
+                chunks = {}
+                start = perf_counter()
+                for i in members:
+                    try:
+                        chunk = files[i].read(COMPARE_CHUNK_SIZE)
+                    except OSError as e:
+                        _check_open_files(e)
+                        continue
+                    read_bytes += len(chunk)
+                    chunks.setdefault(chunk, []).append(i)
+                read_time += perf_counter() - start
+
+                for chunk, same in chunks.items():
+                    # Files with unique contents need no further reading
+                    if len(same) < 2:
+                        continue
+                    if not chunk:
+                        for i in same:
+                            records[i] = (None, hash_obj.digest())
+                        continue
+                    same_hash = hash_obj
+                    if len(chunks) > 1:
+                        same_hash = hash_obj.copy()
+                    start = perf_counter()
+                    same_hash.update(chunk)
+                    hash_time += perf_counter() - start
+                    next_groups.append((same, same_hash))
+            groups = next_groups
+
+        counters.add('hashed_files', len(files))
+        counters.add('read_bytes', read_bytes)
+        counters.add('read_time', read_time)
+        counters.add('hash_time', hash_time)
+    finally:
+        for f in files.values():
+            if read_options.drop_cache:
+                _advise(f, 'dontneed')
+            f.close()
+
+    return records
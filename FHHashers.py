@@ -0,0 +1,61 @@
+# coding=utf-8
+from functools import partial
+from hashlib import blake2b, md5, sha1, sha256
+
+# Hash algorithm names and constructors of their hash objects
+HASHERS = {
+    'sha1': sha1,
+    'md5': md5,
+    'sha256': sha256,
+    'blake2b': partial(blake2b, digest_size=20),
+}
+
+# Algorithms provided by optional packages and the ones used instead when
+# the package is not installed
+FALLBACKS = {
+    'xxh3': 'blake2b',
+    'xxh128': 'blake2b',
+    'blake3': 'blake2b',
+}
+
+
+def register_hasher(name, constructor):
+    '''
+    Add a hash algorithm. The constructor must return an object with
+    hashlib-like update(), digest() and hexdigest() methods.
+    '''
+    HASHERS[name] = constructor
+
+
+try:
+    import xxhash
+    register_hasher('xxh3', xxhash.xxh3_64)
+    register_hasher('xxh128', xxhash.xxh3_128)
+except ImportError:
+    pass
+
+try:
+    import blake3
+    # BLAKE3 hashes large updates in several threads
+    register_hasher('blake3', partial(blake3.blake3,
+                                      max_threads=blake3.blake3.AUTO))
+except ImportError:
+    pass
+
+
+def hash_alg_names():
+    return list(HASHERS) + [name for name in FALLBACKS if name not in HASHERS]
+
+
+def resolve_hash_alg(name):
+    '''
+    Return the name of the algorithm to be used instead of the requested
+    one: itself if available, otherwise its fallback.
+    '''
+    while name not in HASHERS:
+        name = FALLBACKS[name]
+    return name
+
+
+def get_hasher(name):
+    return HASHERS[resolve_hash_alg(name)]
@@ -1,15 +1,91 @@
 # coding=utf-8
-from psutil import Process, cpu_count
+from contextlib import contextmanager
+from sys import platform
+from threading import Lock, local
 from time import perf_counter
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where psutil reports the peak instead
+    resource = None
+
 from FHUtils import human_readable_time, human_readable_size
 
 
+class Counters:
+    '''
+    Counters of the hot paths, e.g. bytes read or time spent hashing. Each
+    thread adds to its own dictionary, so no lock is taken per update; the
+    dictionaries of all threads are summed when the counters are read.
+    '''
+    def __init__(self):
+        self._local = local()
+        self._threads = []
+        self._lock = Lock()
+
+    def _own(self):
+        own = getattr(self._local, 'counters', None)
+        if own is None:
+            own = self._local.counters = {}
+            with self._lock:
+                self._threads.append(own)
+        return own
+
+    def add(self, name, value):
+        own = self._own()
+        own[name] = own.get(name, 0) + value
+
+    def update(self, values):
+        own = self._own()
+        for name, value in values.items():
+            own[name] = own.get(name, 0) + value
+
+    @contextmanager
+    def excluded(self):
+        '''
+        Leave out what the current thread adds inside the block, e.g. work
+        that is not part of the measured scan. The additions go to a
+        dictionary that is never summed.
+        '''
+        own = self._own()
+        self._local.counters = {}
+        try:
+            yield
+        finally:
+            self._local.counters = own
+
+    def totals(self):
+        with self._lock:
+            threads = list(self._threads)
+        totals = {}
+        for own in threads:
+            for name, value in list(own.items()):
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+# Counters of this process
+counters = Counters()
+
+
+def run_counted(task, *args):
+    '''
+    Run a task in a worker process and return its result together with
+    the counters it added, so they can be added to the main process.
+    '''
+    before = counters.totals()
+    result = task(*args)
+    after = counters.totals()
+    return result, {name: value - before.get(name, 0)
+                    for name, value in after.items()}
+
+
 class Metrics:
     def __init__(self):
         self._start_time = perf_counter()
-        self._process = Process()
-        self._cpu_count = cpu_count(logical=True)
+        self._psutil_process = None
+        self._stage_times = {}
 
     @property
     def elapsed_time(self):
@@ -19,6 +95,49 @@ class Metrics:
     def hr_elapsed_time(self):
         return human_readable_time(self.elapsed_time)
 
+    @contextmanager
+    def stage(self, name):
+        '''
+        Measure the time spent in a stage of the program, e.g. the report
+        generation.
+        '''
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._stage_times[name] = self._stage_times.get(name, 0.0) \
+                + perf_counter() - start
+
+    def hr_stage_time(self, name):
+        return human_readable_time(self._stage_times.get(name, 0.0))
+
+    def counter(self, name):
+        return counters.totals().get(name, 0)
+
+    def hr_counter_time(self, name):
+        return human_readable_time(self.counter(name))
+
+    def snapshot(self):
+        '''
+        Return all measurements as a dictionary, e.g. to be saved as JSON.
+        '''
+        return {
+            'elapsed_time': self.elapsed_time,
+            'stage_times': dict(self._stage_times),
+            'counters': counters.totals(),
+            'num_threads': self.num_threads,
+            'mem_usage': self.mem_usage,
+            'peak_mem_usage': self.peak_mem_usage,
+        }
+
+    @property
+    def _process(self):
+        # psutil is only loaded when the process information is shown
+        if self._psutil_process is None:
+            from psutil import Process
+            self._psutil_process = Process()
+        return self._psutil_process
+
     @property
     def num_threads(self):
         return self._process.num_threads()
@@ -27,6 +146,19 @@ class Metrics:
     def mem_usage(self):
         return self._process.memory_info().rss
 
+    @property
+    def peak_mem_usage(self):
+        '''
+        Highest RSS of the process so far or None if it is not known.
+        '''
+        if resource is None:
+            return getattr(self._process.memory_info(), 'peak_wset', None)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes elsewhere
+        if platform != 'darwin':
+            peak *= 1024
+        return peak
+
     @property
     def hr_mem_usage(self):
         return human_readable_size(self.mem_usage)
@@ -37,8 +169,46 @@ class Metrics:
 
     @property
     def cpu_usage_pct(self):
-        return f'{self._process.cpu_percent() / self._cpu_count:.1f}'
+        from psutil import cpu_count
+        return f'{self._process.cpu_percent() / cpu_count(logical=True):.1f}'
 
     @property
     def read_bytes(self):
         return self._process.io_counters().read_bytes
+
+
+class Profiler:
+    '''
+    Profiles the whole run and prints the top entries when stopped: with
+    'cprofile' the functions taking the most time in the main thread, with
+    'tracemalloc' the lines that allocated the most memory in all threads.
+    '''
+    def __init__(self, kind, top=20):
+        self._kind = kind
+        self._top = top
+        self._profile = None
+
+    def start(self):
+        if self._kind == 'cprofile':
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            import tracemalloc
+            tracemalloc.start()
+
+    def stop(self):
+        print()
+        if self._kind == 'cprofile':
+            import pstats
+            self._profile.disable()
+            stats = pstats.Stats(self._profile)
+            stats.sort_stats('cumulative').print_stats(self._top)
+        else:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f' Peak traced memory: {human_readable_size(peak)}')
+            for stat in snapshot.statistics('lineno')[:self._top]:
+                print(f' {stat}')
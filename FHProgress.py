@@ -0,0 +1,41 @@
+# coding=utf-8
+from sys import stdout
+from threading import Event, Thread
+
+# Minimum number of seconds between the lines written when the output is
+# not a terminal
+LOG_INTERVAL = 30.0
+
+
+class Progress(Thread):
+    '''
+    Shows the intermediate results from a separate thread every `interval`
+    seconds, so the scan never waits for the console. When the output is
+    not a terminal, e.g. in cron jobs, plain log lines are written instead
+    of redrawing the screen, and less often.
+    '''
+    def __init__(self, result, interval=1.0):
+        super().__init__(daemon=True)
+        self._result = result
+        self._tty = stdout.isatty()
+        self._interval = interval if self._tty else max(interval,
+                                                        LOG_INTERVAL)
+        self._stopped = Event()
+
+    @property
+    def tty(self):
+        return self._tty
+
+    def show(self):
+        if self._tty:
+            self._result.print_result()
+        else:
+            self._result.print_log()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.show()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
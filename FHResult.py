@@ -1,17 +1,72 @@
 # coding=utf-8
-from FHUtils import ASCII_TITLE, human_readable_size
+import json
+from datetime import datetime
+from heapq import nlargest
+from itertools import chain, count
+from math import inf
+from threading import Lock
+from time import perf_counter
+
+from FHUtils import ASCII_TITLE, human_readable_size, human_readable_time
 from FHMetrics import Metrics
 
+# Number of independently locked parts of the results
+SHARDS = 64
+
+
+def _percent(part, total):
+    if not total:
+        return '0 %'
+    return f'{(100.0 * part / total):.1f} %'
+
+
+class _Shard:
+    '''
+    Part of the results holding the files whose hashes fall into it, with
+    its own lock and counters.
+    '''
+    __slots__ = ('lock', 'total_files', 'total_size', 'originals',
+                 'duplicates', 'group_ids', 'redundancy_files',
+                 'redundancy_size', 'hardlinks', 'hardlink_size')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.total_files = 0
+        self.total_size = 0
+        self.originals = {}
+        self.duplicates = {}
+        self.group_ids = {}
+        self.redundancy_files = 0
+        self.redundancy_size = 0
+        self.hardlinks = []
+        self.hardlink_size = 0
+
 
 class Result:
-    def __init__(self, text, extend_info=False):
+    '''
+    Scan results. The Deduplicator adds all files from the main thread,
+    but the results stay safe to be added to from several threads at
+    once: they are split into shards by file hash, each with its own lock,
+    so the threads rarely wait for each other.
+    '''
+    def __init__(self, text, extend_info=False, blocks=False):
         self._metrics = Metrics()
-        self._total_files = 0
-        self._total_size = 0
-        self._originals = {}
-        self._duplicates = {}
+        self._shards = [_Shard() for _ in range(SHARDS)]
+        self._group_ids = count(1)
+        self._exporter = None
         self._text = text
         self._extend_info = extend_info
+        self._queue_depth = None
+        self._progress = None
+        self._progress_start = None
+
+        # Block-level redundancy, added by the main thread only
+        self._blocks = blocks
+        self._block_size = 0
+        self._block_shared = 0
+        self._block_estimated = False
+        self._block_files = []
+        self._block_folders = {}
 
         self._summary_keys = [
             'total_files',
@@ -19,6 +74,14 @@ class Result:
             'dup_files',
             'dup_size',
             'dup_percent',
+            'hardlinks',
+        ]
+        if self._blocks:
+            self._summary_keys.append('block_shared')
+        self._summary_keys += [
+            'scan_rate',
+            'hash_progress',
+            'time_left',
             'time_passed',
         ]
         if self._extend_info:
@@ -27,30 +90,140 @@ class Result:
                 'mem_usage',
                 'mem_usage_percent',
                 'cpu_usage_percent',
+                'queue_depth',
+                'walk_time',
+                'read_bytes',
+                'read_hash_time',
+                'report_time',
             ])
+            if self._blocks:
+                self._summary_keys.append('chunk_time')
         captions = [getattr(self._text, key) for key in self._summary_keys]
         self._max_caption = len(max(captions, key=len))
 
+    def track_queue(self, queue_depth):
+        '''
+        Set a function returning the current depth of the scan queues to be
+        shown with the advanced information.
+        '''
+        self._queue_depth = queue_depth
+
+    def track_progress(self, progress):
+        '''
+        Set a function returning the numbers of processed and all steps of
+        the scan, or None while the total is not known yet, e.g. during the
+        walk.
+        '''
+        self._progress = progress
+
+    def _hash_progress(self):
+        '''
+        Return the share of processed scan steps and the estimated time
+        left, based on the rate since the total became known.
+        '''
+        progress = self._progress() if self._progress is not None else None
+        if progress is None:
+            return '-', '-'
+        done, total = progress
+        now = perf_counter()
+        if self._progress_start is None:
+            self._progress_start = (now, done)
+        start_time, start_done = self._progress_start
+
+        percent = f'{100.0 * done / total:.1f} %' if total else '100.0 %'
+        if done >= total:
+            return percent, human_readable_time(0)
+        if done == start_done or now == start_time:
+            return percent, '-'
+        rate = (done - start_done) / (now - start_time)
+        return percent, human_readable_time((total - done) / rate)
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def set_exporter(self, exporter):
+        '''
+        Set an exporter to which duplicates are written as soon as they are
+        found.
+        '''
+        self._exporter = exporter
+
+    def _shard(self, filehash):
+        return self._shards[hash(filehash) % SHARDS]
+
     def add_file(self, file):
-        self._total_files += 1
-        self._total_size += file.size
-        self._check_duplicate(file)
+        # Totals do not depend on the hash, any shard will do
+        shard = self._shards[file.size % SHARDS]
+        with shard.lock:
+            shard.total_files += 1
+            shard.total_size += file.size
+
+    def add_hardlink(self, orig_path, file, counted=False):
+        '''
+        Count another path of an already found file. Hardlinks share the
+        disk space of the file, so they are neither duplicates nor added to
+        the total size. A file already counted by add_file() is taken out of
+        the total size.
+        '''
+        shard = self._shards[file.size % SHARDS]
+        with shard.lock:
+            if counted:
+                shard.total_size -= file.size
+            else:
+                shard.total_files += 1
+            shard.hardlinks.append((orig_path, file.record()))
+            shard.hardlink_size += file.size
+
+    def add_known_file(self, record):
+        '''
+        Add a file found by an earlier scan, e.g. in the hash catalog, as the
+        original of its contents, unless they already have one. It is not
+        counted in the totals.
+        '''
+        shard = self._shard(record.digest)
+        with shard.lock:
+            shard.originals.setdefault(record.digest, record)
+
+    def add_chunked_file(self, file, shared_size, estimated=False):
+        '''
+        Count the bytes of a file in content-defined chunks that were seen
+        before, in other files or earlier in the same one. Estimated sizes
+        come from a sample of the chunks and are only limited to the file
+        size where shown.
+        '''
+        self._block_size += file.size
+        self._block_shared += shared_size
+        self._block_estimated = estimated
+        folder = self._block_folders.setdefault(file.folder, [0, 0])
+        folder[0] += file.size
+        folder[1] += shared_size
+        if shared_size:
+            self._block_files.append((file.record(), shared_size))
+
+    def add_hashed_file(self, file):
+        if file.digest is not None:
+            self._check_duplicate(file.record())
 
     @property
     def total_files(self):
-        return self._total_files
+        return sum(shard.total_files for shard in self._shards)
+
+    @property
+    def total_size(self):
+        return sum(shard.total_size for shard in self._shards)
 
     @property
     def hr_total_size(self):
-        return human_readable_size(self._total_size)
+        return human_readable_size(self.total_size)
 
     @property
     def redundancy_files(self):
-        return len(self._duplicates)
+        return sum(shard.redundancy_files for shard in self._shards)
 
     @property
     def redundancy_size(self):
-        return sum(file.size for file in self._duplicates.values())
+        return sum(shard.redundancy_size for shard in self._shards)
 
     @property
     def hr_redundancy_size(self):
@@ -58,49 +231,188 @@ class Result:
 
     @property
     def redundancy_pct(self):
-        if not self._total_size:
-            return '0 %'
-        return f'{(100.0 * self.redundancy_size / self._total_size):.1f} %'
+        return _percent(self.redundancy_size, self.total_size)
+
+    @property
+    def hardlink_files(self):
+        return sum(len(shard.hardlinks) for shard in self._shards)
+
+    @property
+    def hardlink_size(self):
+        return sum(shard.hardlink_size for shard in self._shards)
+
+    @property
+    def hr_hardlink_size(self):
+        return human_readable_size(self.hardlink_size)
+
+    @property
+    def block_shared_size(self):
+        return min(self._block_shared, self._block_size)
+
+    @property
+    def hr_block_shared(self):
+        '''
+        Size of the shared blocks with their share of the chunked bytes,
+        marked with ~ if estimated.
+        '''
+        mark = '~' if self._block_estimated else ''
+        shared = self.block_shared_size
+        return (f'{mark}{human_readable_size(shared)} '
+                f'({_percent(shared, self._block_size)})')
+
+    def get_block_files(self):
+        '''
+        Return (file, shared size, shared percent) of the files sharing
+        blocks, the most shared bytes first.
+        '''
+        for file, shared in sorted(self._block_files, key=lambda x: x[1],
+                                   reverse=True):
+            shared = min(shared, file.size)
+            yield file, shared, _percent(shared, file.size)
+
+    def get_block_folders(self):
+        '''
+        Return (folder, size, shared size, shared percent) of the folders
+        of the chunked files, the most shared bytes first.
+        '''
+        for folder, (size, shared) in sorted(
+                self._block_folders.items(), key=lambda x: x[1][1],
+                reverse=True):
+            shared = min(shared, size)
+            yield folder, size, shared, _percent(shared, size)
+
+    def get_hardlinks(self):
+        '''
+        Return (path of the first found link, hardlink) pairs.
+        '''
+        return chain.from_iterable(shard.hardlinks for shard in self._shards)
 
     def _check_duplicate(self, file):
         '''
         Check whether a file is a duplicate and update the originals/duplicates
-        dictionaries.
-        '''
-        filehash = file.hash
-        orig_file = self._originals.get(filehash)
-
-        # If this is the first file with this hash, store it as an original
-        if orig_file is None:
-            self._originals[filehash] = file
-            return
-
-        # If both files have creation times, choose the older one as
-        # the original
-        if orig_file.ctime and file.ctime:
-            if file.ctime < orig_file.ctime:
-                self._duplicates[filehash] = orig_file
-                self._originals[filehash] = file
-            else:
-                self._duplicates[filehash] = file
-            return
+        dictionaries. Each hash has one original and a list of all its
+        duplicates.
+        '''
+        filehash = file.digest
+        shard = self._shard(filehash)
+        with shard.lock:
+            orig_file = shard.originals.get(filehash)
+
+            # If this is the first file with this hash, store it as
+            # an original
+            if orig_file is None:
+                shard.originals[filehash] = file
+                return
+
+            # All files of a group have the same size, so the redundancy
+            # grows by one file of this size whichever of them is
+            # the original
+            shard.redundancy_files += 1
+            shard.redundancy_size += file.size
+            duplicates = shard.duplicates.get(filehash)
+            if duplicates is None:
+                duplicates = shard.duplicates[filehash] = []
+                shard.group_ids[filehash] = next(self._group_ids)
 
-        # If the creation time is unknown, we simply treat the new file as
-        # a duplicate.
-        self._duplicates[filehash] = file
+            # If both files have creation times, choose the older one as
+            # the original
+            if orig_file.ctime and file.ctime \
+                    and file.ctime < orig_file.ctime:
+                orig_file, file = file, orig_file
+                shard.originals[filehash] = orig_file
+
+            # Otherwise, or if the creation time is unknown, we simply treat
+            # the new file as a duplicate.
+            duplicates.append(file)
+
+            if self._exporter is not None:
+                self._exporter.add_row(shard.group_ids[filehash], orig_file,
+                                       file)
 
     def get_originals(self):
-        return self._originals.values()
+        return chain.from_iterable(shard.originals.values()
+                                   for shard in self._shards)
 
     def get_duplicates(self):
-        return self._duplicates.values()
+        return chain.from_iterable(duplicates for shard in self._shards
+                                   for duplicates in shard.duplicates.values())
+
+    def get_groups(self):
+        '''
+        Return (group ID, original, list of duplicates) of all duplicate
+        groups.
+        '''
+        for shard in self._shards:
+            for filehash, duplicates in shard.duplicates.items():
+                yield (shard.group_ids[filehash], shard.originals[filehash],
+                       duplicates)
+
+    def regroup(self, filehash, groups):
+        '''
+        Replace the duplicate group of a hash with groups of its files, e.g.
+        after a stronger hash told them apart. Groups of fewer than two
+        files are dropped. The original of a group stays its original if it
+        is in it, otherwise the oldest file becomes the original.
+        '''
+        shard = self._shard(filehash)
+        with shard.lock:
+            orig_file = shard.originals[filehash]
+            duplicates = shard.duplicates.pop(filehash)
+            group_id = shard.group_ids.pop(filehash)
+            shard.redundancy_files -= len(duplicates)
+            shard.redundancy_size -= len(duplicates) * orig_file.size
+
+            groups = [files for files in groups if len(files) > 1]
+            for number, files in enumerate(groups):
+                if orig_file not in files:
+                    orig_file = min(files,
+                                    key=lambda file: file.ctime or inf)
+                # Further groups of the same hash get keys of their own
+                key = filehash if not number else (filehash, number)
+                shard.originals[key] = orig_file
+                shard.duplicates[key] = [file for file in files
+                                         if file is not orig_file]
+                shard.group_ids[key] = (group_id if not number
+                                        else next(self._group_ids))
+                shard.redundancy_files += len(files) - 1
+                shard.redundancy_size += (len(files) - 1) * orig_file.size
 
     def get_orig_path_by_hash(self, filehash):
-        return self._originals[filehash].full_path
+        return self._shard(filehash).originals[filehash].full_path
+
+    def _rate(self, counter=None):
+        '''
+        Return the number of scanned files or, if a counter is given, its
+        value per second of the scan.
+        '''
+        elapsed = self._metrics.elapsed_time
+        if not elapsed:
+            return 0.0
+        if counter is None:
+            return self.total_files / elapsed
+        return self._metrics.counter(counter) / elapsed
+
+    def save_metrics(self, filename):
+        '''
+        Save the measurements of the scan with its totals as JSON.
+        '''
+        metrics = self._metrics.snapshot()
+        metrics.update({
+            'total_files': self.total_files,
+            'total_size': self.total_size,
+            'redundancy_files': self.redundancy_files,
+            'redundancy_size': self.redundancy_size,
+            'hardlink_files': self.hardlink_files,
+            'hardlink_size': self.hardlink_size,
+            'block_shared_size': self.block_shared_size,
+            'files_per_second': self._rate(),
+            'read_bytes_per_second': self._rate('read_bytes'),
+        })
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, indent=2)
 
     def get_top10_duplicates(self):
-        return sorted(self.get_duplicates(),
-                      key=lambda x: x.size, reverse=True)[:9]
+        return nlargest(10, self.get_duplicates(), key=lambda x: x.size)
 
     def get_top10_size(self):
         top10_size = sum([file.size for file in self.get_top10_duplicates()])
@@ -112,19 +424,27 @@ class Result:
             file_types[file.ftype] = file_types.get(file.ftype, 0) + 1
         return sorted(file_types.items(), key=lambda x: x[1], reverse=True)
 
-    def print_result(self):
+    def _summary(self):
         '''
-        Print a formatted summary of the current results.
+        Return (caption, value) pairs of the current results. Only counters
+        are read, so this is cheap even for millions of files.
         '''
-        print("\033[H\033[J", end="")
-        print(ASCII_TITLE)
-
+        hash_progress, time_left = self._hash_progress()
         summary = [
             (self._text.total_files, self.total_files),
             (self._text.total_size, self.hr_total_size),
             (self._text.dup_files, self.redundancy_files),
             (self._text.dup_size, self.hr_redundancy_size),
             (self._text.dup_percent, self.redundancy_pct),
+            (self._text.hardlinks,
+             f'{self.hardlink_files} ({self.hr_hardlink_size})'),
+        ]
+        if self._blocks:
+            summary.append((self._text.block_shared, self.hr_block_shared))
+        summary += [
+            (self._text.scan_rate, f'{self._rate():.1f}'),
+            (self._text.hash_progress, hash_progress),
+            (self._text.time_left, time_left),
             (self._text.time_passed, self._metrics.hr_elapsed_time),
         ]
 
@@ -135,9 +455,47 @@ class Result:
                 (self._text.mem_usage_percent, self._metrics.mem_usage_pct),
                 (self._text.cpu_usage_percent, self._metrics.cpu_usage_pct),
             ])
+            if self._queue_depth is not None:
+                summary.append((self._text.queue_depth, self._queue_depth()))
+            metrics = self._metrics
+            summary.extend([
+                (self._text.walk_time,
+                 f'{metrics.hr_counter_time("walk_time")} / '
+                 f'{metrics.hr_counter_time("stat_time")}'),
+                (self._text.read_bytes,
+                 f'{human_readable_size(metrics.counter("read_bytes"))} '
+                 f'({human_readable_size(self._rate("read_bytes"))}/s)'),
+                (self._text.read_hash_time,
+                 f'{metrics.hr_counter_time("read_time")} / '
+                 f'{metrics.hr_counter_time("hash_time")}'),
+            ])
+            if self._blocks:
+                summary.append((self._text.chunk_time,
+                                metrics.hr_counter_time('chunk_time')))
+            summary.append((self._text.report_time,
+                            self._metrics.hr_stage_time('report')))
+        return summary
 
-        for caption, value in summary:
+    def print_result(self, clear=True):
+        '''
+        Print a formatted summary of the current results. With clear=False
+        the screen is not cleared, e.g. when the output is not a terminal.
+        '''
+        if clear:
+            print("\033[H\033[J", end="")
+        print(ASCII_TITLE)
+
+        for caption, value in self._summary():
             if value is None:
                 print(f' {caption}')
             else:
                 print(f' {caption.ljust(self._max_caption)}: {value}')
+
+    def print_log(self):
+        '''
+        Print the current results as a single plain line.
+        '''
+        values = ', '.join(f'{caption}: {value}'
+                           for caption, value in self._summary()
+                           if value is not None)
+        print(f'{datetime.now():%Y-%m-%d %H:%M:%S} {values}', flush=True)
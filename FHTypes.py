@@ -0,0 +1,94 @@
+# coding=utf-8
+from os import path
+from threading import local
+from time import perf_counter
+
+from FHMetrics import counters
+
+# Number of bytes from the beginning of a file used to detect its type
+HEADER_SIZE = 2048
+
+# Types of common formats by file extension. A type is taken from here if
+# the file starts with one of the signatures of its format; other files are
+# identified by libmagic
+_OLE2 = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+_ZIP = b'PK\x03\x04'
+SIGNATURES = {
+    '.jpg': (b'\xff\xd8\xff', 'JPEG image data'),
+    '.jpeg': (b'\xff\xd8\xff', 'JPEG image data'),
+    '.png': (b'\x89PNG\r\n\x1a\n', 'PNG image data'),
+    '.gif': ((b'GIF87a', b'GIF89a'), 'GIF image data'),
+    '.bmp': (b'BM', 'PC bitmap'),
+    '.tif': ((b'II*\x00', b'MM\x00*'), 'TIFF image data'),
+    '.tiff': ((b'II*\x00', b'MM\x00*'), 'TIFF image data'),
+    '.psd': (b'8BPS', 'Adobe Photoshop Image'),
+    '.pdf': (b'%PDF-', 'PDF document'),
+    '.doc': (_OLE2, 'Composite Document File V2 Document'),
+    '.xls': (_OLE2, 'Composite Document File V2 Document'),
+    '.ppt': (_OLE2, 'Composite Document File V2 Document'),
+    '.docx': (_ZIP, 'Microsoft Word 2007+'),
+    '.xlsx': (_ZIP, 'Microsoft Excel 2007+'),
+    '.pptx': (_ZIP, 'Microsoft PowerPoint 2007+'),
+    '.odt': (_ZIP, 'OpenDocument Text'),
+    '.ods': (_ZIP, 'OpenDocument Spreadsheet'),
+    '.zip': (_ZIP, 'Zip archive data'),
+    '.jar': (_ZIP, 'Java archive data (JAR)'),
+    '.gz': (b'\x1f\x8b', 'gzip compressed data'),
+    '.tgz': (b'\x1f\x8b', 'gzip compressed data'),
+    '.bz2': (b'BZh', 'bzip2 compressed data'),
+    '.xz': (b'\xfd7zXZ\x00', 'XZ compressed data'),
+    '.7z': (b"7z\xbc\xaf'\x1c", '7-zip archive data'),
+    '.rar': (b'Rar!\x1a\x07', 'RAR archive data'),
+    '.mp3': (b'ID3', 'Audio file with ID3'),
+    '.flac': (b'fLaC', 'FLAC audio bitstream data'),
+    '.ogg': (b'OggS', 'Ogg data'),
+    '.mkv': (b'\x1aE\xdf\xa3', 'Matroska data'),
+    '.sqlite': (b'SQLite format 3\x00', 'SQLite 3.x database'),
+    '.class': (b'\xca\xfe\xba\xbe', 'compiled Java class data'),
+}
+
+# libmagic is not thread-safe, so each thread has its own instance
+_detectors = local()
+
+
+def _libmagic_type(header):
+    # libmagic and its database are only loaded when types are detected
+    import magic
+    detector = getattr(_detectors, 'detector', None)
+    if detector is None:
+        detector = _detectors.detector = magic.Magic(mime=False)
+    try:
+        return detector.from_buffer(header)
+    except magic.MagicException:
+        return None
+
+
+def detect_file_type(header, extension=''):
+    '''
+    Return the type of a file by the first bytes of its contents and its
+    extension, e.g. "PDF document".
+    '''
+    start = perf_counter()
+    try:
+        known = SIGNATURES.get(extension.lower())
+        if known is not None and header.startswith(known[0]):
+            return known[1]
+        return _libmagic_type(header)
+    finally:
+        counters.add('type_files', 1)
+        counters.add('type_time', perf_counter() - start)
+
+
+def group_type(paths):
+    '''
+    Return the type of a group of files with the same contents, detected
+    from the first of them that can be read, or None.
+    '''
+    for full_path in paths:
+        try:
+            with open(full_path, 'rb') as f:
+                header = f.read(HEADER_SIZE)
+        except OSError:
+            continue
+        return detect_file_type(header, path.splitext(full_path)[1])
+    return None
@@ -1,5 +1,21 @@
 # coding=utf-8
-from math import floor, log
+from math import floor, isfinite, log
+
+try:
+    from resource import getrlimit, RLIMIT_NOFILE, RLIM_INFINITY
+except ImportError:
+    # Not available on Windows
+    getrlimit = None
+
+# Share of the open files allowed to the process that the scan may use for
+# the files it reads at once; the rest is left to the walk, the cache, the
+# catalog and the report
+OPEN_FILES_SHARE = 0.5
+
+# Number of files read at once where the limit cannot be queried, and
+# where the process has no limit
+DEFAULT_OPEN_FILES = 256
+UNLIMITED_OPEN_FILES = 4096
 
 ASCII_TITLE = r'''
   ___ _ _     _  _         _
@@ -30,3 +46,38 @@ def human_readable_size(size):
     units = ['B', 'kB', 'MB', 'GB', 'TB', 'PB']
     i = min(floor(log(size, 1024)), len(units) - 1)
     return f'{size / (1024 ** i):.1f} {units[i]}'
+
+
+def open_files_limit():
+    '''
+    Number of files the scan may keep open at once. The limit of the
+    process is often low, e.g. 1024 on Linux, and files over it cannot be
+    opened at all.
+    '''
+    if getrlimit is None:
+        return DEFAULT_OPEN_FILES
+    soft_limit, _ = getrlimit(RLIMIT_NOFILE)
+    if soft_limit == RLIM_INFINITY:
+        return UNLIMITED_OPEN_FILES
+    return max(int(soft_limit * OPEN_FILES_SHARE), 1)
+
+
+def parse_size(value):
+    '''
+    Convert a size such as 512, 64k, 1.5M or 4 GB into bytes. Units are
+    powers of 1024, as in human_readable_size().
+    '''
+    units = 'bkmgtp'
+    number = value.strip().lower()
+    if number.endswith('b') and len(number) > 1 and number[-2] in units:
+        number = number[:-1]
+    exponent = 0
+    if number and number[-1] in units:
+        exponent = units.index(number[-1])
+        number = number[:-1]
+    size = float(number) * 1024 ** exponent
+    if not isfinite(size):
+        raise ValueError(f'size out of range: {value!r}')
+    if size < 0:
+        raise ValueError(f'negative size: {value!r}')
+    return int(size)
@@ -0,0 +1,303 @@
+# coding=utf-8
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import translate
+from os import name as os_name, path, scandir, sep
+from queue import Queue, SimpleQueue
+from threading import Thread
+from time import perf_counter
+
+from FHMetrics import counters
+
+# Number of files passed through the walker queue at once
+BATCH_SIZE = 256
+
+
+def _compile_globs(patterns):
+    '''
+    Compile glob patterns into a single regular expression and return its
+    match function, or None without patterns.
+    '''
+    if not patterns:
+        return None
+    # File names are case-insensitive on Windows
+    flags = re.IGNORECASE if os_name == 'nt' else 0
+    return re.compile('|'.join(translate(pattern) for pattern in patterns),
+                      flags).match
+
+
+class WalkFilter:
+    '''
+    Rules applied while walking, so that excluded folders are never listed.
+
+    Glob patterns without a path separator match the names of files and
+    folders, the others their paths relative to the scanned folder with /
+    as the separator, e.g. photos/*.tmp or */cache. Include
+    patterns only select files; exclude patterns skip files and whole
+    folders. Folders more than max_depth levels below a scanned folder and
+    folders containing one of the marker files, e.g. .nobackup, are skipped
+    as well. Files outside the size bounds are skipped after their stat.
+    '''
+    def __init__(self, include=(), exclude=(), min_size=0, max_size=None,
+                 max_depth=None, markers=()):
+        self._include_name, self._include_path = self._split(include)
+        self._exclude_name, self._exclude_path = self._split(exclude)
+        self._min_size = min_size
+        self._max_size = max_size
+        self._max_depth = max_depth
+        self._markers = frozenset(markers)
+
+    @staticmethod
+    def _split(patterns):
+        '''
+        Compile the name and the path patterns apart. Raise ValueError for
+        an absolute path pattern, which could never match.
+        '''
+        patterns = [pattern.replace(sep, '/') for pattern in patterns]
+        for pattern in patterns:
+            if pattern.startswith('/') or path.isabs(pattern):
+                raise ValueError(f'path patterns are relative to the scanned'
+                                 f' folders, got {pattern!r}')
+        patterns = [pattern.removeprefix('./') for pattern in patterns]
+        return (_compile_globs([p for p in patterns if '/' not in p]),
+                _compile_globs([p for p in patterns if '/' in p]))
+
+    @staticmethod
+    def _matches(name_match, path_match, entry, offset):
+        if name_match is not None and name_match(entry.name):
+            return True
+        return (path_match is not None and path_match(
+            entry.path[offset:].replace(sep, '/')) is not None)
+
+    def _keep_folder(self, entry, depth, offset):
+        if self._max_depth is not None and depth > self._max_depth:
+            return False
+        return not self._matches(self._exclude_name, self._exclude_path,
+                                 entry, offset)
+
+    def _keep_file(self, entry, offset):
+        if self._matches(self._exclude_name, self._exclude_path, entry,
+                         offset):
+            return False
+        if self._include_name is None and self._include_path is None:
+            return True
+        return self._matches(self._include_name, self._include_path, entry,
+                             offset)
+
+    def entries(self, entries, depth, root):
+        '''
+        Return the folders and files to be walked among the entries of a
+        folder `depth` levels below the scanned folder root: nothing if the
+        folder holds a marker file.
+        '''
+        entries = list(entries)
+        if self._markers and any(entry.name in self._markers
+                                 for entry in entries):
+            counters.add('skipped_folders', 1)
+            return []
+        # Entry paths start with the root and a separator
+        offset = len(path.join(root, ''))
+        kept = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if self._keep_folder(entry, depth + 1, offset):
+                    kept.append(entry)
+                else:
+                    counters.add('skipped_folders', 1)
+            elif self._keep_file(entry, offset):
+                kept.append(entry)
+            else:
+                counters.add('skipped_files', 1)
+        return kept
+
+    def keep_size(self, size):
+        if self._min_size <= size and (self._max_size is None
+                                       or size <= self._max_size):
+            return True
+        counters.add('skipped_files', 1)
+        return False
+
+
+def iter_files(base_folder, walk_filter=None, depth=0, root=None):
+    '''
+    Recursively traverses a folder, returning os.DirEntry objects of all
+    files kept by the walk filter, if any. The folder is `depth` levels
+    below the scanned folder root, by default itself.
+    '''
+    if root is None:
+        root = base_folder
+    try:
+        with scandir(base_folder) as entries:
+            if walk_filter is not None:
+                entries = walk_filter.entries(entries, depth, root)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from iter_files(entry.path, walk_filter, depth + 1,
+                                          root)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+    except PermissionError:
+        return
+
+
+def _stat(entry):
+    '''
+    Return the stat of a file entry, or None if it is gone.
+    '''
+    start = perf_counter()
+    try:
+        return entry.stat(follow_symlinks=False)
+    except OSError:
+        return None
+    finally:
+        counters.add('stat_time', perf_counter() - start)
+
+
+def iter_file_stats(base_folders, walk_filter=None):
+    '''
+    Traverses folders one by one, returning (path, stat) pairs of all files
+    kept by the walk filter, if any.
+    '''
+    for base_folder in base_folders:
+        for entry in iter_files(base_folder, walk_filter):
+            file_stat = _stat(entry)
+            if file_stat is None:
+                continue
+            if (walk_filter is not None
+                    and not walk_filter.keep_size(file_stat.st_size)):
+                continue
+            yield entry.path, file_stat
+
+
+def _list_folder(folder, walk_filter=None, depth=0, root=None):
+    '''
+    Lists one folder `depth` levels below the scanned folder root, returning
+    its subfolders and (path, stat) pairs of its files kept by the walk
+    filter, if any.
+    '''
+    folders, files = [], []
+    try:
+        with scandir(folder) as entries:
+            if walk_filter is not None:
+                entries = walk_filter.entries(entries, depth,
+                                              root or folder)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    file_stat = _stat(entry)
+                    if file_stat is None:
+                        continue
+                    if (walk_filter is not None
+                            and not walk_filter.keep_size(file_stat.st_size)):
+                        continue
+                    files.append((entry.path, file_stat))
+    except PermissionError:
+        pass
+    return folders, files
+
+
+def iter_file_stats_parallel(base_folders, jobs, executor=None,
+                             walk_filter=None):
+    '''
+    Traverses folders listing up to `jobs` of them at once, returning
+    (path, stat) pairs of all files kept by the walk filter, if any. On
+    network shares this hides the latency of directory listing requests.
+    With an executor given, e.g. the asyncio engine, the folders are listed
+    by it instead.
+
+    A listing counts against `jobs` until its files have been consumed, so
+    a paused consumer also pauses the listing.
+    '''
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            yield from iter_file_stats_parallel(base_folders, jobs, executor,
+                                                walk_filter)
+        return
+
+    listed = SimpleQueue()
+    # Folders not listed yet; taken from the end, so the walk goes deep
+    # first and only keeps the siblings of the current path waiting
+    waiting = deque((folder, 0, folder) for folder in reversed(base_folders))
+    pending = 0
+
+    def submit(folder, depth, root):
+        nonlocal pending
+        pending += 1
+        executor.submit(_list_folder, folder, walk_filter, depth,
+                        root).add_done_callback(
+            lambda future: listed.put((future, depth, root)))
+
+    while waiting or pending:
+        while waiting and pending < jobs:
+            submit(*waiting.pop())
+        future, depth, root = listed.get()
+        folders, files = future.result()
+        waiting.extend((folder, depth + 1, root)
+                       for folder in reversed(folders))
+        yield from files
+        pending -= 1
+
+
+class Walker(Thread):
+    '''
+    Walks the folders in a separate thread and feeds (path, stat) pairs of
+    the found files into a bounded queue. The walk is paused while the queue
+    is full, so it never runs more than queue_size files ahead of hashing.
+    With jobs > 1 up to `jobs` folders are listed at once. With an executor
+    given, the folders are listed by it. A WalkFilter given as walk_filter
+    prunes the walk.
+    '''
+    def __init__(self, folders, queue_size=100000, jobs=1, executor=None,
+                 walk_filter=None):
+        super().__init__(daemon=True)
+        self._folders = folders
+        self._jobs = jobs
+        self._executor = executor
+        self._walk_filter = walk_filter
+        self._queue = Queue(maxsize=max(queue_size // BATCH_SIZE, 1))
+        self._error = None
+        self._found_files = 0
+
+    @property
+    def found_files(self):
+        return self._found_files
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() * BATCH_SIZE
+
+    def run(self):
+        if self._jobs > 1 or self._executor is not None:
+            file_stats = iter_file_stats_parallel(self._folders, self._jobs,
+                                                  self._executor,
+                                                  self._walk_filter)
+        else:
+            file_stats = iter_file_stats(self._folders, self._walk_filter)
+
+        batch = []
+        start = perf_counter()
+        try:
+            for file_stat in file_stats:
+                batch.append(file_stat)
+                self._found_files += 1
+                if len(batch) == BATCH_SIZE:
+                    # Waiting for a free place in the queue is not walk time
+                    counters.add('walk_time', perf_counter() - start)
+                    self._queue.put(batch)
+                    start = perf_counter()
+                    batch = []
+        except Exception as e:
+            self._error = e
+        finally:
+            counters.add('walk_time', perf_counter() - start)
+            if batch:
+                self._queue.put(batch)
+            self._queue.put(None)
+
+    def __iter__(self):
+        while (batch := self._queue.get()) is not None:
+            yield from batch
+        if self._error is not None:
+            raise self._error
@@ -2,18 +2,40 @@
 import argparse
 from datetime import datetime
 from importlib import import_module
-from os import scandir, path, rename, getcwd
+from itertools import chain, islice
+from os import name as os_name, path, rename, getcwd, stat
 from sys import exit
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from types import SimpleNamespace
-import xlsxwriter
-from colorama import init
 
-from FHFile import File
+from FHCache import HashCache
+from FHCatalog import Catalog
+from FHChunks import ChunkIndex
+from FHCheckpoint import Checkpoint
+from FHDedup import Deduplicator, PENDING_PER_WORKER
+from FHExport import EXPORTERS, get_exporter
+from FHFile import File, ReadOptions, compare_files, hash_files
+from FHHashers import hash_alg_names, resolve_hash_alg
+from FHMetrics import Profiler, run_counted
+from FHProgress import Progress
 from FHResult import Result
-from FHUtils import ASCII_TITLE
+from FHUtils import ASCII_TITLE, human_readable_size, parse_size
+from FHWalker import Walker, WalkFilter
 
-init()
+# Heavy dependencies are imported where they are used: xlsxwriter for Excel
+# reports, multiprocessing for -p, asyncio for -o async, psutil for -e and
+# magic for -t. Only Windows consoles need colorama to understand the screen
+# control codes
+if os_name == 'nt':
+    from colorama import init
+    init()
+
+# Maximum number of rows in an Excel sheet
+MAX_SHEET_ROWS = 1048576
+
+# Number of report rows used to estimate the column widths
+REPORT_SAMPLE_ROWS = 1000
 
 
 class NestedNamespace(SimpleNamespace):
@@ -26,25 +48,11 @@ class NestedNamespace(SimpleNamespace):
                 self.__setattr__(key, value)
 
 
-def iter_files(base_folder):
-    '''
-    Recursively traverses a folder, returning paths to all files.
-    '''
-    try:
-        with scandir(base_folder) as entries:
-            for entry in entries:
-                if entry.is_dir(follow_symlinks=False):
-                    yield from iter_files(entry.path)
-                elif entry.is_file(follow_symlinks=False):
-                    yield entry.path
-    except PermissionError:
-        return
-
-
 def get_report_filename(scanning_folders, report_file):
     '''
-    Generate a valid .xlsx report filename based on scan folders or
-    user input.
+    Generate a valid report filename based on scan folders or user input.
+    The report is an .xlsx file unless one of the export formats (.csv,
+    .jsonl or, with pyarrow installed, .parquet) is specified.
     '''
     curr_dirname = getcwd()
     if not report_file:
@@ -59,9 +67,11 @@ def get_report_filename(scanning_folders, report_file):
         dirname = path.dirname(report_file)
         if not path.exists(dirname):
             dirname = curr_dirname
-        # Make sure the extension is .xlsx
-        report_file = path.splitext(report_file)[0] + '.xlsx'
-        report_file = path.join(dirname, path.basename(report_file))
+        # Make sure the extension is .xlsx or one of the export formats
+        report_file, ext = path.splitext(report_file)
+        if ext.lower() not in EXPORTERS:
+            ext = '.xlsx'
+        report_file = path.join(dirname, path.basename(report_file) + ext)
 
     # If the report file with the specified name already exists,
     # rename the old file by adding the date/time of its change
@@ -69,16 +79,144 @@ def get_report_filename(scanning_folders, report_file):
     if path.isfile(report_file):
         mtime = datetime.fromtimestamp(path.getmtime(report_file))
         mtime = mtime.strftime('%Y-%m-%d_%H%M%S')
-        rename(report_file, f'{path.splitext(report_file)[0]}_{mtime}.xlsx')
+        report_name, ext = path.splitext(report_file)
+        rename(report_file, f'{report_name}_{mtime}{ext}')
 
     return report_file
 
 
+def device_limit(value):
+    '''
+    Parse a -d option value: NUMBER or FOLDER=NUMBER.
+    '''
+    folder, _, number = value.rpartition('=')
+    try:
+        number = int(number)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f'expected NUMBER or FOLDER=NUMBER with a positive number, '
+            f'got {value!r}')
+    return folder, number
+
+
+# Longest interval of the -i option in seconds. Larger values are taken
+# for the number of files that -i used to be given in
+MAX_PROGRESS_INTERVAL = 60.0
+
+
+def progress_interval(value):
+    '''
+    Parse a -i option value: SECONDS from above 0 to MAX_PROGRESS_INTERVAL.
+    '''
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = 0.0
+    if seconds > MAX_PROGRESS_INTERVAL:
+        raise argparse.ArgumentTypeError(
+            f'the interval is given in seconds, at most '
+            f'{MAX_PROGRESS_INTERVAL:g}, got {value!r}; -i used to take a '
+            f'number of files')
+    if not seconds > 0:
+        raise argparse.ArgumentTypeError(
+            f'expected a positive number of seconds, got {value!r}')
+    return seconds
+
+
+# Walk rules of the -z option and the parsers of their values
+WALK_RULES = {
+    'include': str,
+    'min': parse_size,
+    'max': parse_size,
+    'depth': int,
+    'marker': str,
+}
+
+
+def walk_rule(value):
+    '''
+    Parse a -z option value: NAME=VALUE with a name of WALK_RULES.
+    '''
+    name, _, rule_value = value.partition('=')
+    try:
+        parsed = WALK_RULES[name](rule_value)
+    except (KeyError, ValueError):
+        parsed = None
+    if not rule_value or parsed is None or (name == 'depth' and parsed < 0):
+        raise argparse.ArgumentTypeError(
+            f'expected include=PATTERN, min=SIZE, max=SIZE, depth=NUMBER '
+            f'or marker=NAME, got {value!r}')
+    return name, parsed
+
+
+def get_walk_filter(exclude, rules):
+    '''
+    Make the walk filter of the -v and -z options, or None without them.
+    '''
+    if not exclude and not rules:
+        return None
+    values = {name: [] for name in WALK_RULES}
+    for name, value in rules:
+        values[name].append(value)
+    return WalkFilter(include=values['include'], exclude=exclude,
+                      min_size=max(values['min'], default=0),
+                      max_size=min(values['max'], default=None),
+                      max_depth=min(values['depth'], default=None),
+                      markers=values['marker'])
+
+
+def iter_report_rows(result):
+    '''
+    Return rows of the Detailed sheet one by one, group after group.
+    '''
+    for _, orig, duplicates in result.get_groups():
+        orig_path = orig.full_path
+        for dup in duplicates:
+            yield [orig_path, dup.full_path, dup.hr_size, dup.hash, dup.ftype]
+
+
+def column_width(values, min_width=8, max_width=60):
+    '''
+    Estimate the width of a column from a sample of its values.
+    '''
+    width = max((len(str(value)) for value in values if value is not None),
+                default=0)
+    return min(max(width + 2, min_width), max_width)
+
+
+def write_sheets(workbook, name, setup, rows):
+    '''
+    Write rows below the caption row of a sheet prepared by
+    setup(worksheet). Excel sheets are limited to MAX_SHEET_ROWS rows, the
+    remaining rows go to additional sheets named "name (2)" and so on.
+    '''
+    sheets = 1
+    worksheet = workbook.add_worksheet(name)
+    setup(worksheet)
+    row = 0
+    for data in rows:
+        row += 1
+        if row == MAX_SHEET_ROWS:
+            sheets += 1
+            worksheet = workbook.add_worksheet(f'{name} ({sheets})')
+            setup(worksheet)
+            row = 1
+        worksheet.write_row(row, 0, data)
+
+
 def generate_report(report_filename, text, result, args):
     '''
     Generate an Excel report summarizing duplicate file results.
+
+    The workbook is written in the constant memory mode: rows go straight to
+    disk in order, so the data of each sheet is written row by row.
     '''
-    with xlsxwriter.Workbook(report_filename) as workbook:
+    import xlsxwriter
+
+    options = {'constant_memory': True}
+    with xlsxwriter.Workbook(report_filename, options) as workbook:
         # === Colors and styles ===
         colors = {'purple': '#D2D2FF', 'pink': '#FFCECE'}
         fmt = {
@@ -115,75 +253,136 @@ def generate_report(report_filename, text, result, args):
             }),
         }
 
-        # === Worksheets ===
-        ws_detailed = workbook.add_worksheet(text.ws_detailed)
-        ws_summary = workbook.add_worksheet(text.ws_summary)
-
-        # === Details Sheet ===
+        # === Details Sheets ===
         captions = (text.cap1_A1, text.cap1_B1, text.cap1_C1, text.cap1_D1,)
         if args.t:
             captions += (text.cap1_E1,)
-        ws_detailed.write_row('A1', captions, fmt['cap'])
-
-        for row, dup in enumerate(result.get_duplicates(), start=1):
-            data = [
-                result.get_orig_path_by_hash(dup.hash),
-                dup.full_path,
-                dup.hr_size,
-                dup.hash,
-                dup.ftype
-            ]
-            ws_detailed.write_row(row, 0, data)
+
+        # Column widths are estimated from the first rows instead of
+        # autofit(), which needs all the data in memory
+        rows = iter_report_rows(result)
+        sample = list(islice(rows, REPORT_SAMPLE_ROWS))
+        widths = [column_width([caption] + [row[col] for row in sample])
+                  for col, caption in enumerate(captions)]
+
+        def setup_detailed_sheet(worksheet):
+            worksheet.set_column('A:B', 60)
+            for col in range(2, len(captions)):
+                worksheet.set_column(col, col, widths[col])
+            if args.t:
+                worksheet.set_column('E:E', 50)
+            worksheet.freeze_panes('A2')
+            worksheet.autofilter(0, 0, 0, len(captions) - 1)
+            worksheet.write_row('A1', captions, fmt['cap'])
+
+        write_sheets(workbook, text.ws_detailed, setup_detailed_sheet,
+                     (data[:len(captions)] for data in chain(sample, rows)))
+
+        # === Hardlinks Sheets (optional) ===
+        def setup_hardlinks_sheet(worksheet):
+            worksheet.set_column('A:B', 60)
+            worksheet.set_column('C:C', 12)
+            worksheet.freeze_panes('A2')
+            worksheet.write_row('A1', (text.cap5_A1, text.cap5_B1,
+                                       text.cap1_C1), fmt['cap'])
+
+        if result.hardlink_files:
+            write_sheets(workbook, text.ws_hardlinks, setup_hardlinks_sheet,
+                         ((orig_path, file.full_path, file.hr_size)
+                          for orig_path, file in result.get_hardlinks()))
+
+        # === Shared Blocks Sheets (optional) ===
+        def block_sheet_setup(first_caption):
+            def setup(worksheet):
+                worksheet.set_column('A:A', 60)
+                worksheet.set_column('B:D', 14)
+                worksheet.freeze_panes('A2')
+                worksheet.write_row('A1', (first_caption, text.cap1_C1,
+                                           text.cap6_C1, text.cap6_D1),
+                                    fmt['cap'])
+            return setup
+
+        if args.y is not None:
+            write_sheets(workbook, text.ws_blocks,
+                         block_sheet_setup(text.cap6_A1),
+                         ((file.full_path, file.hr_size,
+                           human_readable_size(shared), percent)
+                          for file, shared, percent
+                          in result.get_block_files()))
+            write_sheets(workbook, text.ws_block_folders,
+                         block_sheet_setup(text.cap7_A1),
+                         ((folder, human_readable_size(size),
+                           human_readable_size(shared), percent)
+                          for folder, size, shared, percent
+                          in result.get_block_folders()))
 
         # === Summary Sheet ===
+        ws_summary = workbook.add_worksheet(text.ws_summary)
+
+        # Cells are collected first and then written row by row
+        cells = {}
+
+        def add_cell(row, col, value, cell_fmt):
+            cells.setdefault(row, []).append((col, value, cell_fmt))
+
         captions = (text.cap2_A1, text.cap2_A2, text.cap2_A3,
-                    text.cap2_A4, text.cap2_A5,)
+                    text.cap2_A4, text.cap2_A5, text.cap2_A6, text.cap2_A7,)
         summary_values = [
             str(result.total_files),
             result.hr_total_size,
             str(result.redundancy_files),
             result.hr_redundancy_size,
-            result.redundancy_pct
+            result.redundancy_pct,
+            str(result.hardlink_files),
+            result.hr_hardlink_size,
         ]
-        ws_summary.write_column('A1', captions, fmt['cap_left'])
-        ws_summary.write_column('B1', summary_values[:2], fmt['data_cntr'])
-        ws_summary.write_column('B3', summary_values[2:],
-                                fmt['data_cntr_light'])
+        if args.y is not None:
+            captions += (text.cap2_A8,)
+            summary_values.append(result.hr_block_shared)
+        for row, caption in enumerate(captions):
+            add_cell(row, 0, caption, fmt['cap_left'])
+        for row, value in enumerate(summary_values):
+            # Only the duplicate rows are highlighted
+            add_cell(row, 1, value,
+                     fmt['data_cntr_light'] if 2 <= row <= 4
+                     else fmt['data_cntr'])
 
         # === Top 10 Duplicates ===
-        ws_summary.write('D1', text.cap3_D1, fmt['cap'])
-        ws_summary.write('E1', text.cap3_E1, fmt['cap'])
+        add_cell(0, 3, text.cap3_D1, fmt['cap'])
+        add_cell(0, 4, text.cap3_E1, fmt['cap'])
 
         row = 1
+        top10_sizes = [text.cap3_E1]
         for file in result.get_top10_duplicates():
-            ws_summary.write(row, 3, file.full_path, fmt['data_left'])
-            ws_summary.write(row, 4, file.hr_size, fmt['data_cntr'])
+            add_cell(row, 3, file.full_path, fmt['data_left'])
+            add_cell(row, 4, file.hr_size, fmt['data_cntr'])
+            top10_sizes.append(file.hr_size)
             row += 1
-        ws_summary.write(row, 4, result.get_top10_size(),
-                         fmt['data_bold_cntr_light'])
+        add_cell(row, 4, result.get_top10_size(), fmt['data_bold_cntr_light'])
 
         # === File Types (optional) ===
         if args.t:
-            ws_summary.write('G1', text.cap4_G1, fmt['cap'])
-            ws_summary.write('H1', text.cap4_H1, fmt['cap'])
+            add_cell(0, 6, text.cap4_G1, fmt['cap'])
+            add_cell(0, 7, text.cap4_H1, fmt['cap'])
             for row, file_types in enumerate(result.get_file_types(), start=1):
-                ws_summary.write(row, 6, file_types[0], fmt['data_left'])
-                ws_summary.write(row, 7, file_types[1], fmt['data_cntr'])
+                add_cell(row, 6, file_types[0], fmt['data_left'])
+                add_cell(row, 7, file_types[1], fmt['data_cntr'])
 
-        # === Formatting ===
-        ws_detailed.autofit()
-        ws_detailed.set_column('A:B', 60)
-        ws_detailed.freeze_panes('A2')
-        ws_detailed.autofilter('A1:{}1'.format('E' if args.t else 'D'))
-        if args.t:
-            ws_detailed.set_column('E:E', 50)
+        for row in sorted(cells):
+            for col, value, cell_fmt in sorted(cells[row],
+                                               key=lambda cell: cell[0]):
+                ws_summary.write(row, col, value, cell_fmt)
 
-        ws_summary.autofit()
+        # === Formatting ===
+        ws_summary.set_column('A:A', column_width(captions))
+        ws_summary.set_column('B:B', column_width(summary_values))
         ws_summary.set_column('C:C', 2)
         ws_summary.set_column('D:D', 60)
+        ws_summary.set_column('E:E', column_width(top10_sizes))
         ws_summary.set_column('F:F', 2)
         if args.t:
             ws_summary.set_column('G:G', 50)
+            ws_summary.set_column('H:H', column_width([text.cap4_H1]))
 
 
 if __name__ == '__main__':
@@ -211,16 +410,17 @@ Examples:
     Scans the folder d:\\folder for duplicate files using the MD5 hash
     algorithm instead of the default SHA1.
 
-    The results are saved to an Excel report file named result.xlsx
-    (note: even if .csv is specified, the program automatically generates
-    .xlsx format).
+    The results are saved to a CSV file named result.csv. Duplicates are
+    written to it as soon as they are found, so it can be read while the
+    scan goes on. Other extensions than .csv, .jsonl and .parquet are
+    replaced with .xlsx.
 
-  > FileHasher \\\\shared\\folder -i 100 -t
+  > FileHasher \\\\shared\\folder -i 5 -t
 
     Scans the shared network folder \\shared\folder for duplicate files.
 
-    The -i 100 option means that intermediate results will be shown every
-    100 processed files.
+    The -i 5 option means that intermediate results will be shown every
+    5 seconds.
 
     The -t option enables file type detection (e.g., "JPEG image data" or
     "Microsoft Word Document").
@@ -233,65 +433,314 @@ Examples:
 
     The report will automatically be saved as an Excel file named
     folder1_folder2.xlsx in the current working directory.
+
+  > FileHasher d:\\folder1 \\\\shared\\folder2 -w 16 -d d:\\=1 -q
+
+    Scans the same folders with up to 16 files read at once from the
+    network share, but only one at a time, in on-disk order, from the
+    local hard disk d:.
+
+  > FileHasher e:\\backup -g catalog.db -u
+  > FileHasher d:\\photos -g catalog.db
+
+    Adds the files of the backup disk e: to the catalog, then reports the
+    files in d:\\photos that already exist on the backup disk without
+    scanning it again.
+
+  > FileHasher \\\\shared\\projects -v .git -v node_modules -z include=*.psd
+        -z min=1M -z marker=.nobackup
+
+    Scans only the Photoshop files of at least 1 MB on the share. The .git
+    and node_modules folders and the folders holding a .nobackup file are
+    not even listed.
+
+  > FileHasher d:\\vm_images -r images.xlsx -p -y 256
+
+    Also reports how much of each virtual disk image and folder is made
+    of blocks found elsewhere in the images, e.g. a shared base system,
+    even where the files are not identical.
 '''
 
     parser.add_argument('folder', metavar='FOLDER', type=str, nargs='+',
                         help='The path to the folder, including the name of\
  the folder\nitself. Several folders can be specified (see Examples)')
-    parser.add_argument('-a', choices=['sha1', 'md5'], default='sha1',
-                        help=u'Hash algorithm sha1 (default) or md5')
+    parser.add_argument('-a', choices=hash_alg_names(), default='sha1',
+                        help=u'Hash algorithm sha1 (default), md5, sha256,\
+ blake2b or, if\nthe xxhash or blake3 package is installed, xxh3, xxh128,\
+\nblake3 (blake2b is used instead if the package is missing)')
+    parser.add_argument('-b', action='store_true',
+                        help=u'Compare candidate files byte by byte instead\
+ of hashing\neach of them. Reading stops as soon as the files differ')
+    parser.add_argument('-c', metavar='CACHE.DB', required=False, type=str,
+                        help=u'Hash cache file. Hashes of files unchanged\
+ since the previous\nscan are taken from it instead of reading the files')
+    parser.add_argument('-d', metavar='LIMIT', type=device_limit,
+                        action='append', default=[],
+                        help=u'Maximum number of files read at once from\
+ one device. In the\nFOLDER=NUMBER form the limit applies to the device of\
+ the\nfolder only. Can be given several times, e.g. -d 2 -d\nd:\\=1 to read\
+ one file at a time from the d: hard disk\nand two from each other device')
     parser.add_argument('-e', action='store_true',
                         help=u'Display advanced information such as memory\
 consumption')
-    parser.add_argument('-i', metavar='NUMBER', type=int, default=1000,
-                        help=u'After how many scanned files an intermediate\
-result should be\nshown')
+    parser.add_argument('-f', choices=['cprofile', 'tracemalloc'],
+                        help=u'Profile the run and print the functions of\
+ the main thread\ntaking the most time (cprofile) or the lines allocating\
+ the\nmost memory (tracemalloc)')
+    parser.add_argument('-g', metavar='CATALOG.DB', required=False, type=str,
+                        help=u'Catalog of earlier scans. Files that already\
+ exist in it, e.g.\non another volume scanned before, are reported as\
+\nduplicates of the catalogued files. Only files of a size\nfound in the\
+ catalog are hashed for that')
+    parser.add_argument('-i', metavar='SECONDS', type=progress_interval,
+                        default=1.0,
+                        help=u'How often the intermediate result is shown\
+ (default 1, at\nmost 60). When the output is not a terminal, a plain line\
+\nis written at most every 30 seconds')
+    parser.add_argument('-j', metavar='JOBS', type=int, default=1,
+                        help=u'Number of folders listed at once. Values above\
+ 1 speed up\nscanning of network folders')
+    parser.add_argument('-k', metavar='KIB', type=int, default=256,
+                        help=u'Size of the read buffer in KiB (default 256)')
     parser.add_argument('-l', choices=['en', 'ru'], default='en',
                         help=u'Language of output to the console and\
 to the report file')
+    parser.add_argument('-m', metavar='METRICS.JSON', required=False,
+                        type=str,
+                        help=u'Save the timings and counters of the scan\
+ stages, e.g. the\nwalk time, bytes read and hashing time, to a JSON file')
+    parser.add_argument('-n', action='store_true',
+                        help=u'Do not keep the read files in the OS page\
+ cache, so the scan\ndoes not evict data of other programs (Linux only)')
+    parser.add_argument('-o', choices=['read', 'readinto', 'mmap', 'async'],
+                        default='readinto',
+                        help=u'How files are read: into a reusable buffer\
+ (default), into\nnew objects, mapped into memory (files from 4 MiB), or\
+\nthrough asyncio (async), which keeps up to -w reads and\nfolder listings\
+ in flight, backing off when their latency\nrises, and at most half as many\
+ files open as the\nprocess may open. Meant for network shares, e.g. with\
+\n-w 1000')
+    parser.add_argument('-p', action='store_true',
+                        help=u'Hash files in worker processes instead of\
+ threads to use\nall CPU cores')
+    parser.add_argument('-q', action='store_true',
+                        help=u'Read the files waiting for a device limited\
+ with -d in the\norder of their inode numbers, which reduces seeking on\
+ hard\ndisks')
     parser.add_argument('-r', metavar='RESULT.XLSX', required=False, type=str,
                         help=u'Excel file with the result. If it was not\
 specified, it is\ncreated in the program folder with the name of the scanned\
-\nfolder')
+\nfolder. With the .csv, .jsonl or .parquet (requires pyarrow)\nextension\
+ the duplicates are exported to that format instead')
+    parser.add_argument('-s', action='store_true',
+                        help=u'Verify the found duplicates with the strong\
+ SHA-256 hash.\nUseful with the fast non-cryptographic xxh3 and xxh128')
     parser.add_argument('-t', action='store_true',
-                        help=u'Detect file type, e.g. "Microsoft Excel 2007+"\
- or\n"ISO 9660 CD-ROM"')
+                        help=u'Detect file type of the duplicates, e.g.\
+ "Microsoft Excel\n2007+" or "ISO 9660 CD-ROM"')
+    parser.add_argument('-x', metavar='CHECKPOINT', required=False, type=str,
+                        help=u'Checkpoint file. Computed hashes are saved to\
+ it during the\nscan. If the scan is interrupted, run it again with the same\
+\nfile to skip the files hashed before. The file is removed\nonce the scan\
+ is completed')
+    parser.add_argument('-u', action='store_true',
+                        help=u'Add the scanned files to the catalog given\
+ with -g, replacing\nthe files of the scanned folders from earlier scans.\
+ All\nfiles are hashed for that')
+    parser.add_argument('-v', metavar='PATTERN', action='append', default=[],
+                        help=u'Skip the files and folders matching the glob\
+ pattern, e.g.\n-v .git -v node_modules -v "*.tmp". Patterns with a path\
+\nseparator match paths relative to the scanned folder,\ne.g. photos/*.tmp.\
+ Skipped folders are not listed. Can be\ngiven several times')
     parser.add_argument('-w', metavar='WORKERS', type=int, default=2,
-                        help=u'Maximum number of worker threads for file\
-processing')
+                        help=u'Maximum number of worker threads (or processes\
+ with -p)\nfor file processing')
+    parser.add_argument('-y', metavar='MIB', type=int,
+                        help=u'Also measure redundancy at the block level:\
+ files are split\ninto content-defined chunks of about 8 KiB while they are\
+\nhashed, and the Excel report shows how much of each file\nand folder is\
+ made of chunks seen before. All files are\nhashed for that. The chunk index\
+ takes up to MIB MiB of\nmemory, e.g. -y 256; beyond that the shared size\
+ is\nestimated from a sample of the chunks')
+    parser.add_argument('-z', metavar='RULE', type=walk_rule,
+                        action='append', default=[],
+                        help=u'Walk rule: include=PATTERN to scan only the\
+ matching files,\nmin=SIZE and max=SIZE to scan only files of these sizes,\
+\ne.g. max=4G, depth=NUMBER to scan at most that many levels\nof subfolders\
+ and marker=NAME to skip the folders holding\na file of that name, e.g.\
+ .nobackup. Skipped folders are\nnot listed. Can be given several times')
 
     args = parser.parse_args()
+    args.a = resolve_hash_alg(args.a)
+    if args.u and not args.g:
+        parser.error('argument -u: requires the catalog (-g)')
+    if args.o == 'async' and args.p:
+        parser.error('argument -o: async cannot be used with -p')
+    if args.y is not None and args.b:
+        parser.error('argument -y: cannot be used with -b')
+    if args.y is not None and args.y <= 0:
+        parser.error('argument -y: the memory limit must be positive')
+    try:
+        walk_filter = get_walk_filter(args.v, args.z)
+    except ValueError as e:
+        parser.error(f'argument -v/-z: {e}')
+
+    profiler = Profiler(args.f) if args.f else None
+    if profiler is not None:
+        profiler.start()
 
     report_filename = get_report_filename(args.folder, args.r)
 
     text = NestedNamespace(import_module(f'locales.{args.l}').text)
 
-    result = Result(text.cli, extend_info=args.e)
-    result.print_result()
+    result = Result(text.cli, extend_info=args.e, blocks=(args.y is not None))
 
-    all_files = []
-    for sf in args.folder:
-        for file_path in iter_files(sf):
-            if not path.islink(file_path):
-                all_files.append(file_path)
+    # Export formats are written while scanning, unless the duplicates
+    # have to be verified or their types detected first
+    exporter = get_exporter(report_filename)
+    if exporter is not None and not (args.s or args.t):
+        result.set_exporter(exporter)
 
-    def process_file(file_path):
-        file = File(file_path, hash_alg=args.a, check_type=args.t)
-        if file.size:
-            file.set_file_data()
-            result.add_file(file)
+    progress = Progress(result, interval=max(args.i, 0.1))
+    progress.show()
 
-    iters = args.i if 10 <= args.i <= 10000 else 1000
     workers = args.w if args.w > 0 else 1
+    cache = HashCache(args.c, args.a) if args.c else None
+    if args.x:
+        cache = Checkpoint(args.x, args.a, cache=cache)
+    read_options = ReadOptions(args.o, max(args.k, 4) * 1024, args.n,
+                               chunking=(args.y is not None))
+    chunk_index = None
+    if args.y is not None:
+        chunk_index = ChunkIndex(args.y * 1024 * 1024)
+
+    catalog = None
+    if args.g:
+        catalog = Catalog(args.g, args.a)
+        catalog.exclude(args.folder)
+        if args.u:
+            catalog.forget(args.folder)
+
+    # Limits of the devices are looked up by the device number
+    device_limits = {}
+    default_limit = None
+    for folder, number in args.d:
+        if not folder:
+            default_limit = number
+            continue
+        try:
+            device_limits[stat(folder).st_dev] = number
+        except OSError as e:
+            parser.error(f'argument -d: {e}')
+
+    if args.p:
+        from concurrent.futures import ProcessPoolExecutor
+        executor_class = ProcessPoolExecutor
+        batch_hasher = partial(hash_files, hash_alg=args.a,
+                               read_options=read_options)
+    elif args.o == 'async':
+        from FHAsync import AsyncEngine
+        executor_class = AsyncEngine
+        batch_hasher = None
+    else:
+        executor_class = ThreadPoolExecutor
+        batch_hasher = None
+    comparer = None
+    if args.b:
+        comparer = partial(compare_files, hash_alg=args.a,
+                           read_options=read_options)
+
+    # Counters of the worker processes are passed back with the results
+    if args.p:
+        batch_hasher = partial(run_counted, batch_hasher)
+        if comparer is not None:
+            comparer = partial(run_counted, comparer)
 
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = [executor.submit(process_file, fp) for fp in all_files]
-        for i, future in enumerate(as_completed(futures), 1):
-            if result.total_files % iters == 0:
-                result.print_result()
-
-    generate_report(report_filename, text.xls, result, args)
-
-    result.print_result()
+    try:
+        with executor_class(max_workers=workers) as executor:
+            dedup = Deduplicator(executor, result,
+                                 max_pending=workers * PENDING_PER_WORKER,
+                                 batch_hasher=batch_hasher, comparer=comparer,
+                                 device_limits=device_limits,
+                                 default_limit=default_limit, ordered=args.q,
+                                 counted=args.p, catalog=catalog,
+                                 update_catalog=args.u,
+                                 coroutines=(args.o == 'async'),
+                                 chunk_index=chunk_index)
+
+            # The folders are walked in a separate thread. Only files with
+            # a shared size are hashed, so hashing starts while the walk
+            # goes on.
+            # The asyncio engine lists the folders as well, up to -w of
+            # them at once unless -j allows more
+            jobs = max(args.j, workers if args.o == 'async' else 1)
+            walker = Walker(args.folder, jobs=jobs,
+                            executor=(executor if args.o == 'async'
+                                      else None),
+                            walk_filter=walk_filter)
+            walker.start()
+            result.track_queue(
+                lambda: f'{walker.queue_depth} / {dedup.pending}')
+
+            def scan_progress():
+                # The total is only known after the walk. Each file counts
+                # once when it is taken from the walker and once for each
+                # hashing stage it passes
+                if walker.is_alive():
+                    return None
+                processed, submitted = dedup.progress
+                return (result.total_files + processed,
+                        walker.found_files + submitted)
+
+            result.track_progress(scan_progress)
+            progress.start()
+
+            for file_path, file_stat in walker:
+                dedup.add_file(File(file_path, hash_alg=args.a,
+                                    file_stat=file_stat, cache=cache,
+                                    read_options=read_options))
+                dedup.collect()
+
+            # Files compared byte by byte are submitted after the walk
+            while dedup.pending or dedup.submit_compared():
+                dedup.collect(block=True)
+
+            if args.s:
+                dedup.verify(read_options=read_options)
+            if args.t:
+                with result.metrics.stage('types'):
+                    dedup.detect_types()
+    except KeyboardInterrupt:
+        progress.stop()
+        # Keep the hashes computed so far for the next scan
+        if cache is not None:
+            cache.close(completed=False)
+        if catalog is not None:
+            catalog.close()
+        raise
+
+    progress.stop()
+    if cache is not None:
+        cache.close()
+    if catalog is not None:
+        catalog.close()
+
+    with result.metrics.stage('report'):
+        if exporter is None:
+            generate_report(report_filename, text.xls, result, args)
+        else:
+            # Verified or typed duplicates are only exported now
+            if args.s or args.t:
+                for group_id, orig, duplicates in result.get_groups():
+                    for dup in duplicates:
+                        exporter.add_row(group_id, orig, dup)
+            exporter.close()
+
+    result.print_result(clear=progress.tty)
     print(f'\n {text.cli.done}!')
     print(f' {text.cli.report_created} {report_filename}')
+
+    if args.m:
+        result.save_metrics(args.m)
+    if profiler is not None:
+        profiler.stop()
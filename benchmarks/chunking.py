@@ -0,0 +1,69 @@
+# coding=utf-8
+'''
+Measure content-defined chunking (-y option) on random data:
+
+    python -m benchmarks.chunking [--size 64] [--target 20]
+
+Shows the throughput of the chunker, the average chunk size and the share
+of chunks that are found again after a few bytes are inserted into the
+data. Fails (exit code 1) if the throughput is below --target MB/s.
+'''
+import argparse
+import hashlib
+import sys
+from random import Random
+from time import perf_counter
+
+from FHChunks import Chunker, ChunkIndex
+from FHUtils import human_readable_size
+
+# Size of the pieces the data is fed to the chunker in, as by the file reads
+READ_SIZE = 256 * 1024
+
+
+def chunk(data):
+    '''
+    Split data into chunks and return their fingerprints and sizes.
+    '''
+    chunker = Chunker(hashlib.sha1())
+    with memoryview(data) as view:
+        for offset in range(0, len(data), READ_SIZE):
+            chunker.update(view[offset:offset + READ_SIZE])
+    return chunker.chunks()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', metavar='MIB', type=int, default=64,
+                        help='Size of the random data in MiB')
+    parser.add_argument('--target', metavar='MB/S', type=float,
+                        default=20.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    random = Random(1)
+    data = random.randbytes(args.size * 1024 * 1024)
+
+    elapsed = None
+    for _ in range(args.repeat):
+        start = perf_counter()
+        fingerprints, sizes = chunk(data)
+        run_time = perf_counter() - start
+        elapsed = run_time if elapsed is None else min(elapsed, run_time)
+    rate = len(data) / elapsed / 1e6
+
+    print(f' Data: {human_readable_size(len(data))}, '
+          f'{len(sizes)} chunks of {len(data) // len(sizes)} B on average')
+    print(f' Throughput: {rate:.1f} MB/s (target {args.target:g} MB/s)')
+
+    # Only the chunks around the insertion may change
+    middle = len(data) // 2
+    shifted = data[:middle] + b'inserted' + data[middle:]
+    index = ChunkIndex(64 * 1024 * 1024)
+    index.add(fingerprints, sizes)
+    shifted_fingerprints, shifted_sizes = chunk(shifted)
+    shared = index.add(shifted_fingerprints, shifted_sizes)
+    print(f' Found again after an insertion: '
+          f'{100.0 * shared / len(shifted):.2f} %')
+
+    sys.exit(1 if rate < args.target else 0)
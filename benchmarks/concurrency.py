@@ -0,0 +1,94 @@
+# coding=utf-8
+'''
+Stress the result aggregation from many threads at once and check that
+the totals are exact:
+
+    python -m benchmarks.concurrency [--threads 32] [--files 20000]
+
+Each thread adds its files twice: once as found by the walk and once as
+hashed. Every hash is shared by `--copies` files of different threads.
+Fails (exit code 1) if a thread dies or the threads do not all start
+within --timeout seconds.
+'''
+import argparse
+from sys import exit
+from threading import Barrier, BrokenBarrierError, Thread
+from time import perf_counter
+from types import SimpleNamespace
+
+from FHFile import File
+from FHResult import Result
+from locales.en import text
+
+
+def worker(result, barrier, errors, thread, files, copies):
+    try:
+        added = []
+        for i in range(files):
+            group = (thread * files + i) // copies
+            file_stat = SimpleNamespace(st_size=group % 1000 + 1,
+                                        st_ctime=i, st_mtime_ns=i, st_dev=1,
+                                        st_ino=i + 1, st_nlink=1)
+            file = File(f'/bench/{thread}/{i}', file_stat=file_stat)
+            file.set_hashes(None, group.to_bytes(8, 'big'), None)
+            added.append(file)
+
+        # Start all threads at once for the highest contention
+        barrier.wait()
+        for file in added:
+            result.add_file(file)
+            result.add_hashed_file(file)
+    except BaseException as e:
+        # The other threads must not wait for this one at the barrier
+        barrier.abort()
+        errors.append(e)
+        raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--copies', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    result = Result(SimpleNamespace(**text['cli']))
+    barrier = Barrier(args.threads + 1, timeout=args.timeout)
+    errors = []
+    threads = [Thread(target=worker, args=(result, barrier, errors, thread,
+                                           args.files, args.copies))
+               for thread in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    try:
+        barrier.wait()
+    except BrokenBarrierError:
+        barrier.abort()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    if errors or barrier.broken:
+        print(f' Failed: {len(errors)} of {args.threads} threads died'
+              if errors else ' Failed: the threads did not start in time')
+        exit(1)
+
+    count = args.threads * args.files
+    groups = range((count + args.copies - 1) // args.copies)
+    total_size = sum((i // args.copies) % 1000 + 1 for i in range(count))
+    expected = {
+        'total_files': count,
+        'total_size': total_size,
+        'redundancy_files': count - len(groups),
+        'redundancy_size': total_size - sum(g % 1000 + 1 for g in groups),
+    }
+
+    print(f' {count} files from {args.threads} threads in {elapsed:.2f} s '
+          f'({2 * count / elapsed:.0f} additions/s)')
+    failed = False
+    for name, value in expected.items():
+        actual = getattr(result, name)
+        print(f' {name.ljust(16)}: {actual} (expected {value})')
+        failed = failed or actual != value
+    exit(1 if failed else 0)
@@ -0,0 +1,70 @@
+# coding=utf-8
+'''
+Compare the I/O engines and read buffer sizes used for full hashing over
+files of several size buckets:
+
+    python -m benchmarks.io [--buffers 64 256 1024] [--algorithm sha1]
+
+The files are read from the page cache, so the results show the overhead of
+the engines rather than the disk speed.
+'''
+import argparse
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from FHFile import File, ReadOptions
+from FHUtils import human_readable_size
+
+# File size bucket and number of files in it
+SIZE_BUCKETS = (
+    (4 * 1024, 2000),
+    (64 * 1024, 1000),
+    (1024 * 1024, 200),
+    (16 * 1024 * 1024, 16),
+    (128 * 1024 * 1024, 2),
+)
+
+
+def make_files(folder, size, count):
+    paths = []
+    data = bytes(range(256)) * (size // 256 + 1)
+    for i in range(count):
+        paths.append(path.join(folder, f'{size}_{i}.bin'))
+        with open(paths[-1], 'wb') as f:
+            f.write(data[i % 256:i % 256 + size])
+    return paths
+
+
+def measure(paths, hash_alg, read_options, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for full_path in paths:
+            File(full_path, hash_alg=hash_alg,
+                 read_options=read_options).set_file_data()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--algorithm', type=str, default='sha1')
+    parser.add_argument('--buffers', metavar='KIB', type=int, nargs='+',
+                        default=[64, 256, 1024])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        for size, count in SIZE_BUCKETS:
+            paths = make_files(tmp, size, count)
+            print(f' {human_readable_size(size)} x {count}')
+            for engine in ('read', 'readinto', 'mmap'):
+                for buffer_kib in args.buffers:
+                    options = ReadOptions(engine, buffer_kib * 1024)
+                    elapsed = measure(paths, args.algorithm, options,
+                                      args.repeat)
+                    print(f'   {engine.ljust(8)} {buffer_kib:>5} KiB: '
+                          f'{size * count / elapsed / 1024 ** 2:8.0f} MB/s, '
+                          f'{count / elapsed:8.0f} files/s')
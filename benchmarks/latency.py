@@ -0,0 +1,131 @@
+# coding=utf-8
+'''
+Compare the thread pool with the asyncio engine (-o async) on a simulated
+high-latency network share:
+
+    python -m benchmarks.latency [--delay 0.005] [--workers 16 128]
+        [--async-workers 256 1024]
+
+Each scan is a separate FileHasher process whose file opens, reads,
+closes and folder listings are delayed by --delay seconds, so a local
+synthetic tree behaves like a distant share. The delay does not keep the
+CPU busy, as with real network I/O.
+'''
+import argparse
+import runpy
+import subprocess
+import sys
+from os import path, scandir
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+from FHUtils import human_readable_size
+from benchmarks.tree import make_dataset
+
+PROGRAM = path.join(path.dirname(path.dirname(path.abspath(__file__))),
+                    'FileHasher.py')
+
+
+class DelayedFile:
+    '''
+    File object whose reads take `delay` seconds longer.
+    '''
+    def __init__(self, f, delay):
+        self._f = f
+        self._delay = delay
+
+    def read(self, *args):
+        sleep(self._delay)
+        return self._f.read(*args)
+
+    def readinto(self, buffer):
+        sleep(self._delay)
+        return self._f.readinto(buffer)
+
+    def close(self):
+        sleep(self._delay)
+        self._f.close()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_delayed(delay, argv):
+    '''
+    Run FileHasher in this process with delayed file and folder access.
+    '''
+    import FHFile
+    import FHWalker
+    real_pread = FHFile.pread
+
+    def delayed_open(*args, **kwargs):
+        sleep(delay)
+        return DelayedFile(open(*args, **kwargs), delay)
+
+    def delayed_pread(fd, size, offset):
+        sleep(delay)
+        return real_pread(fd, size, offset)
+
+    def delayed_scandir(folder):
+        sleep(delay)
+        return scandir(folder)
+
+    FHFile.open = delayed_open
+    if real_pread is not None:
+        FHFile.pread = delayed_pread
+    FHWalker.scandir = delayed_scandir
+    sys.argv = argv
+    runpy.run_path(PROGRAM, run_name='__main__')
+
+
+def run_scan(folder, tmp, delay, workers, engine):
+    command = [sys.executable, '-m', 'benchmarks.latency', '--run',
+               str(delay), PROGRAM, folder, '-w', str(workers), '-o', engine,
+               '-i', '60', '-r', path.join(tmp, 'report.csv')]
+    start = perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run_delayed(float(sys.argv[2]), sys.argv[3:])
+        sys.exit()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--max-size', type=int, default=1024 * 1024)
+    parser.add_argument('--dup-ratio', type=float, default=0.3)
+    parser.add_argument('--delay', type=float, default=0.005,
+                        help='Latency of each open, read and listing in\
+ seconds')
+    parser.add_argument('--workers', type=int, nargs='+', default=[16, 128],
+                        help='Worker threads of the thread pool runs')
+    parser.add_argument('--async-workers', type=int, nargs='+',
+                        default=[256, 1024],
+                        help='Highest numbers of operations in flight of the\
+ asyncio engine runs')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        folder = path.join(tmp, 'tree')
+        total_size = make_dataset(folder, files=args.files,
+                                  max_size=args.max_size,
+                                  dup_ratio=args.dup_ratio)
+        print(f' {args.files} files, {human_readable_size(total_size)}, '
+              f'{args.delay * 1000:g} ms per operation')
+
+        runs = [('readinto', workers) for workers in args.workers]
+        runs += [('async', workers) for workers in args.async_workers]
+        for engine, workers in runs:
+            elapsed = run_scan(folder, tmp, args.delay, workers, engine)
+            name = 'threads' if engine != 'async' else 'asyncio'
+            print(f' {name} x {workers}'.ljust(20) +
+                  f': {elapsed:6.2f} s, '
+                  f'{args.files / elapsed:7.0f} files/s')
@@ -0,0 +1,67 @@
+# coding=utf-8
+'''
+Measure the memory used per tracked file with the process RSS shown by
+the -e option:
+
+    python -m benchmarks.memory [--files 1000000] [--per-folder 100]
+
+Files are synthetic, nothing is read from the disk. Two costs are reported:
+files waiting in the size index of the duplicate search (every file with
+a unique size) and hashed files kept in the results.
+'''
+import argparse
+from gc import collect
+from types import SimpleNamespace
+
+from FHDedup import Deduplicator
+from FHFile import File
+from FHMetrics import Metrics
+from FHResult import Result
+from FHUtils import human_readable_size
+from locales.en import text
+
+
+def fake_stat(i):
+    return SimpleNamespace(st_size=i + 1, st_ctime=1.0e9 + i,
+                           st_mtime_ns=i, st_dev=1, st_ino=i + 1,
+                           st_nlink=1)
+
+
+def make_files(count, per_folder):
+    for i in range(count):
+        folder = f'/srv/share/folder{i // per_folder}/subfolder'
+        yield File(f'{folder}/file{i}.bin', file_stat=fake_stat(i))
+
+
+def report(caption, metrics, before, count):
+    collect()
+    used = metrics.mem_usage - before
+    print(f' {caption.ljust(14)}: {human_readable_size(used)}, '
+          f'{used / count:.0f} bytes per file')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--per-folder', type=int, default=100)
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    result = Result(SimpleNamespace(**text['cli']))
+
+    # Every file has a unique size, so all of them stay in the size index
+    collect()
+    before = metrics.mem_usage
+    dedup = Deduplicator(None, result)
+    for file in make_files(args.files, args.per_folder):
+        dedup.add_file(file)
+    report('Size index', metrics, before, args.files)
+    del dedup
+
+    # Every file has a unique hash, so all of them are kept as originals
+    collect()
+    before = metrics.mem_usage
+    for i, file in enumerate(make_files(args.files, args.per_folder)):
+        file.set_hashes(None, i.to_bytes(20, 'big'), None)
+        result.add_hashed_file(file)
+    report('Results', metrics, before, args.files)
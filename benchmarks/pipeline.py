@@ -0,0 +1,141 @@
+# coding=utf-8
+'''
+Run the whole FileHasher scan (walk, hashing, results and report) on a
+reproducible synthetic tree with several worker counts and hash
+algorithms:
+
+    python -m benchmarks.pipeline [--files 2000] [--workers 1 4 16]
+        [--algorithms sha1 xxh3] [--processes] [--output results.json]
+        [--compare old_results.json]
+
+Each run is a separate FileHasher process started with -m, so the numbers
+are those of the real program: throughput, peak RSS of the main process
+and the time of each stage. The best of --repeat runs is kept. The tree
+is read from the page cache after the first run, so the results show the
+CPU side of the scan rather than the disk speed.
+
+The results are saved as JSON. Results of another version of the program
+given with --compare are shown side by side with the new ones.
+'''
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from FHUtils import human_readable_size
+from benchmarks.tree import make_dataset
+
+PROGRAM = path.join(path.dirname(path.dirname(path.abspath(__file__))),
+                    'FileHasher.py')
+
+# Counters of the -m output kept for each run
+STAGE_COUNTERS = ('walk_time', 'stat_time', 'read_time', 'hash_time',
+                  'type_time')
+
+
+def run_scan(folder, tmp, hash_alg, workers, processes, report_ext):
+    '''
+    Scan the folder with a FileHasher process and return its measurements.
+    '''
+    metrics_file = path.join(tmp, 'metrics.json')
+    command = [sys.executable, PROGRAM, folder, '-a', hash_alg,
+               '-w', str(workers), '-i', '60', '-m', metrics_file,
+               '-r', path.join(tmp, f'report{report_ext}')]
+    if processes:
+        command.append('-p')
+    start = perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    elapsed = perf_counter() - start
+    with open(metrics_file, encoding='utf-8') as f:
+        metrics = json.load(f)
+
+    counters = metrics['counters']
+    return {
+        'elapsed_time': elapsed,
+        'files_per_second': metrics['total_files'] / elapsed,
+        'bytes_per_second': metrics['total_size'] / elapsed,
+        'read_bytes': counters.get('read_bytes', 0),
+        'peak_mem_usage': metrics['peak_mem_usage'],
+        'report_time': metrics['stage_times'].get('report', 0.0),
+        **{name: counters.get(name, 0.0) for name in STAGE_COUNTERS},
+    }
+
+
+def run_key(run):
+    return f'{run["algorithm"]}, {run["mode"]} x {run["workers"]}'
+
+
+def print_run(run, old_run=None):
+    line = (f' {run_key(run).ljust(26)}: '
+            f'{run["files_per_second"]:8.0f} files/s, '
+            f'{human_readable_size(run["bytes_per_second"])}/s, '
+            f'peak RSS {human_readable_size(run["peak_mem_usage"] or 0)}')
+    if old_run is not None:
+        speedup = run['files_per_second'] / old_run['files_per_second']
+        line += f', {speedup:.2f}x of old'
+    print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--min-size', type=int, default=1024)
+    parser.add_argument('--max-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--dup-ratio', type=float, default=0.3)
+    parser.add_argument('--hardlink-ratio', type=float, default=0.05)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--width', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--algorithms', nargs='+', default=['sha1'])
+    parser.add_argument('--processes', action='store_true',
+                        help='Also run with worker processes (-p)')
+    parser.add_argument('--report', choices=['.xlsx', '.csv'],
+                        default='.xlsx')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=str, default='results.json')
+    parser.add_argument('--label', type=str, default=None,
+                        help='Name of the tested version, e.g. a git commit')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Results of another version to compare with')
+    args = parser.parse_args()
+
+    old_runs = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            old_runs = {run_key(run): run for run in json.load(f)['runs']}
+
+    tree = {name: getattr(args, name) for name in (
+        'files', 'min_size', 'max_size', 'dup_ratio', 'hardlink_ratio',
+        'depth', 'width', 'seed')}
+    modes = ['threads'] + (['processes'] if args.processes else [])
+
+    runs = []
+    with TemporaryDirectory() as tmp:
+        folder = path.join(tmp, 'tree')
+        total_size = make_dataset(folder, **tree)
+        print(f' {args.files} files, {human_readable_size(total_size)}')
+
+        for hash_alg in args.algorithms:
+            for mode in modes:
+                for workers in args.workers:
+                    best = min((run_scan(folder, tmp, hash_alg, workers,
+                                         mode == 'processes', args.report)
+                                for _ in range(args.repeat)),
+                               key=lambda run: run['elapsed_time'])
+                    run = {'algorithm': hash_alg, 'mode': mode,
+                           'workers': workers, **best}
+                    print_run(run, old_runs.get(run_key(run)))
+                    runs.append(run)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'label': args.label,
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'tree': tree,
+                   'runs': runs}, f, indent=2)
+    print(f' Results are saved to {args.output}')
@@ -0,0 +1,67 @@
+# coding=utf-8
+'''
+Check the startup time of the program with python -X importtime:
+
+    python -m benchmarks.startup [--budget 100] [--repeat 5]
+
+Fails (exit code 1) if a heavy optional dependency is imported at startup,
+as they must only be loaded by the features that use them, or if importing
+the program takes longer than the budget in milliseconds. The slowest
+imports are listed to find the cause.
+'''
+import argparse
+import subprocess
+import sys
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+# Modules that must not be imported before the feature using them runs
+HEAVY_MODULES = ('magic', 'psutil', 'xlsxwriter', 'pyarrow', 'colorama',
+                 'multiprocessing', 'asyncio')
+
+
+def import_times():
+    '''
+    Import the program in a new interpreter and return the cumulative
+    import time in microseconds of each imported module.
+    '''
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import FileHasher'],
+        cwd=ROOT, check=True, capture_output=True, text=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', metavar='MS', type=float, default=100.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    # The first run also fills the bytecode cache
+    runs = [import_times() for _ in range(args.repeat + 1)][1:]
+    times = min(runs, key=lambda run: run['FileHasher'])
+    total = times['FileHasher'] / 1000
+
+    heavy = sorted(name for name in times
+                   if name.split('.')[0] in HEAVY_MODULES)
+    print(f' Import time: {total:.1f} ms (budget {args.budget:.0f} ms)')
+    for name, cumulative in sorted(times.items(), key=lambda item: item[1],
+                                   reverse=True)[1:args.top + 1]:
+        print(f'   {name.ljust(40)} {cumulative / 1000:8.1f} ms')
+
+    failed = False
+    if heavy:
+        print(f' Imported at startup: {", ".join(heavy)}')
+        failed = True
+    if total > args.budget:
+        print(' The import time is over the budget')
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,67 @@
+# coding=utf-8
+from math import exp, log
+from os import link, makedirs, path
+from random import Random
+
+
+def make_tree(root, depth=4, width=6, files_per_folder=8, file_size=64):
+    '''
+    Create a synthetic tree of folders `depth` levels deep with `width`
+    subfolders and `files_per_folder` files in each folder. Return the
+    number of created files.
+    '''
+    created = 0
+    makedirs(root, exist_ok=True)
+    for i in range(files_per_folder):
+        with open(path.join(root, f'file{i}.bin'), 'wb') as f:
+            f.write(bytes([i % 256]) * file_size)
+        created += 1
+    if depth > 0:
+        for i in range(width):
+            created += make_tree(path.join(root, f'dir{i}'), depth - 1,
+                                 width, files_per_folder, file_size)
+    return created
+
+
+def make_dataset(root, files=2000, min_size=1024, max_size=4 * 1024 * 1024,
+                 size_step=4096, dup_ratio=0.3, hardlink_ratio=0.05,
+                 depth=3, width=4, seed=1):
+    '''
+    Create a reproducible tree of `files` files for duplicate search. File
+    sizes follow a log-uniform distribution between min_size and max_size,
+    rounded to size_step so that files of the same size but different
+    contents are common. A dup_ratio share of the files are copies and a
+    hardlink_ratio share are hardlinks of earlier files. The files are put
+    into random folders of a tree `depth` levels deep with `width`
+    subfolders in each folder. Return the total size of the created files.
+    '''
+    random = Random(seed)
+    folders = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [path.join(folder, f'dir{i}') for folder in level
+                 for i in range(width)]
+        folders.extend(level)
+    for folder in folders:
+        makedirs(folder, exist_ok=True)
+
+    created = []
+    total_size = 0
+    for i in range(files):
+        file_path = path.join(random.choice(folders), f'file{i}.bin')
+        kind = random.random()
+        if created and kind < hardlink_ratio:
+            link(random.choice(created), file_path)
+            continue
+        if created and kind < hardlink_ratio + dup_ratio:
+            with open(random.choice(created), 'rb') as f:
+                data = f.read()
+        else:
+            size = exp(random.uniform(log(min_size), log(max_size)))
+            size = max(int(size) // size_step * size_step, size_step)
+            data = random.randbytes(size)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        created.append(file_path)
+        total_size += len(data)
+    return total_size
@@ -0,0 +1,55 @@
+# coding=utf-8
+'''
+Compare the recursive and the parallel folder walkers on a synthetic
+deep/wide tree:
+
+    python -m benchmarks.walker [--depth 4] [--width 6] [--jobs 4 16]
+'''
+import argparse
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from FHUtils import human_readable_time
+from FHWalker import iter_file_stats, iter_file_stats_parallel
+from benchmarks.tree import make_tree
+
+
+def measure(walk, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        count = sum(1 for _ in walk())
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--width', type=int, default=6)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--jobs', type=int, nargs='+', default=[2, 4, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--folder', type=str, default=None,
+                        help='Walk an existing folder, e.g. a network share,\
+ instead of a synthetic tree')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        folder = args.folder
+        if folder is None:
+            folder = tmp
+            make_tree(folder, args.depth, args.width, args.files)
+
+        walkers = [('recursive', lambda: iter_file_stats([folder]))]
+        for jobs in args.jobs:
+            walkers.append((f'parallel, {jobs} jobs',
+                            lambda jobs=jobs: iter_file_stats_parallel(
+                                [folder], jobs)))
+
+        for name, walk in walkers:
+            count, elapsed = measure(walk, args.repeat)
+            print(f' {name.ljust(20)}: {count} files in '
+                  f'{human_readable_time(elapsed)} '
+                  f'({count / elapsed:.0f} files/s)')
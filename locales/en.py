@@ -6,10 +6,21 @@ text = {
         'dup_files': 'Redundancy files',
         'dup_size': 'Redundancy size',
         'dup_percent': 'Redundancy, %',
+        'hardlinks': 'Hardlinks',
+        'block_shared': 'Shared blocks',
+        'hash_progress': 'Progress',
+        'time_left': 'Time left',
         'num_threads': 'Number of threads',
         'mem_usage': 'Memory usage',
         'mem_usage_percent': 'Memory usage, %',
         'cpu_usage_percent': 'CPU usage, %',
+        'queue_depth': 'Queue (walk / hash)',
+        'walk_time': 'Walk / stat time',
+        'read_bytes': 'Read',
+        'read_hash_time': 'Read / hash time',
+        'chunk_time': 'Chunking time',
+        'scan_rate': 'Files per second',
+        'report_time': 'Report generation time',
         'time_passed': 'Time passed',
         'done': 'DONE',
         'report_created': 'A detailed report can be found here:',
@@ -17,6 +28,9 @@ text = {
     'xls': {
         'ws_detailed': 'Detailed',
         'ws_summary': 'Summary',
+        'ws_hardlinks': 'Hardlinks',
+        'ws_blocks': 'Shared blocks',
+        'ws_block_folders': 'Shared blocks by folder',
         'cap1_A1': 'Original file',
         'cap1_B1': 'Duplicate file',
         'cap1_C1': 'Size',
@@ -27,9 +41,18 @@ text = {
         'cap2_A3': 'Duplicates',
         'cap2_A4': 'Occupied by duplicates',
         'cap2_A5': 'Percentage of duplicates',
+        'cap2_A6': 'Hardlinks',
+        'cap2_A7': 'Shared by hardlinks',
+        'cap2_A8': 'In blocks seen before',
         'cap3_D1': 'Top ten biggest duplicates',
         'cap3_E1': 'Size',
         'cap4_G1': 'Duplicate files by type',
         'cap4_H1': 'Quantity',
+        'cap5_A1': 'First found path',
+        'cap5_B1': 'Hardlink',
+        'cap6_A1': 'File',
+        'cap6_C1': 'In shared blocks',
+        'cap6_D1': 'Shared, %',
+        'cap7_A1': 'Folder',
     },
 }
@@ -6,10 +6,21 @@ text = {
         'dup_files': 'Дубликаты',
         'dup_size': 'Дубликаты, размер',
         'dup_percent': 'Дубликаты, %',
+        'hardlinks': 'Жесткие ссылки',
+        'block_shared': 'Общие блоки',
+        'hash_progress': 'Выполнено',
+        'time_left': 'Осталось времени',
         'num_threads': 'Количество потоков',
         'mem_usage': 'Задействовано памяти',
         'mem_usage_percent': 'Задействовано памяти, %',
         'cpu_usage_percent': 'Задействовано CPU, %',
+        'queue_depth': 'Очередь (обход / хэш)',
+        'walk_time': 'Обход / stat, время',
+        'read_bytes': 'Прочитано',
+        'read_hash_time': 'Чтение / хэш, время',
+        'chunk_time': 'Разбиение на блоки',
+        'scan_rate': 'Файлов в секунду',
+        'report_time': 'Создание отчета',
         'time_passed': 'Прошло времени',
         'done': 'ГОТОВО',
         'report_created': 'Подробный отчет можно найти здесь:',
@@ -17,6 +28,9 @@ text = {
     'xls': {
         'ws_detailed': 'Подробно',
         'ws_summary': 'Итог',
+        'ws_hardlinks': 'Жесткие ссылки',
+        'ws_blocks': 'Общие блоки',
+        'ws_block_folders': 'Общие блоки по папкам',
         'cap1_A1': 'Оригинальный файл',
         'cap1_B1': 'Дублирующий файл',
         'cap1_C1': 'Размер',
@@ -27,9 +41,18 @@ text = {
         'cap2_A3': 'Дубликатов',
         'cap2_A4': 'Занято дубликатами',
         'cap2_A5': 'Процент дубликатов',
+        'cap2_A6': 'Жестких ссылок',
+        'cap2_A7': 'Занято жесткими ссылками',
+        'cap2_A8': 'В повторяющихся блоках',
         'cap3_D1': 'Десятка самых больших дубликатов',
         'cap3_E1': 'Размер',
         'cap4_G1': 'Дублирующие файлы по типу',
         'cap4_H1': 'Кол-во',
+        'cap5_A1': 'Первый найденный путь',
+        'cap5_B1': 'Жесткая ссылка',
+        'cap6_A1': 'Файл',
+        'cap6_C1': 'В общих блоках',
+        'cap6_D1': 'Общих, %',
+        'cap7_A1': 'Папка',
     },
 }